@@ -0,0 +1,141 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import JsonResponse
+from django.views import View
+from rest_framework import exceptions
+from rest_framework.authentication import get_authorization_header
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+from backend.authentication import CachedTokenAuthentication
+from backend.basket import RedisBasket
+from backend.pagination import OrderCursorPagination
+from backend.serializers import OrderSerializer, ProductInfoSerializer
+from backend.views import get_product_infos, get_basket, get_orders
+
+
+class AsyncView(View):
+    '''Базовый класс асинхронных представлений для чтения.
+
+    Авторизация по заголовку "Authorization: Token <key>", как в CachedTokenAuthentication.
+    Частота запросов ограничивается теми же классами, что и у APIView (DEFAULT_THROTTLE_CLASSES).
+    Запросы к базе данных выполняются через асинхронный интерфейс ORM,
+    поток сервера не занят на время ожидания базы данных и медленного клиента.
+
+    '''
+
+    throttle_classes = api_settings.DEFAULT_THROTTLE_CLASSES
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await self.authenticate(request)
+        except exceptions.AuthenticationFailed as error:
+            return JsonResponse({'detail': str(error.detail)}, status=401)
+        try:
+            await sync_to_async(self.check_throttles)(request)
+        except exceptions.Throttled as error:
+            response = JsonResponse({'detail': str(error.detail)}, status=error.status_code)
+            if error.wait is not None:
+                response['Retry-After'] = str(error.wait)
+            return response
+        return await super().dispatch(request, *args, **kwargs)
+
+    def check_throttles(self, request):
+        '''Проверить ограничители частоты запросов, как APIView.check_throttles'''
+        waits = [throttle.wait() for throttle in (throttle_class() for throttle_class in self.throttle_classes)
+                 if not throttle.allow_request(request, self)]
+        if waits:
+            waits = [wait for wait in waits if wait is not None]
+            raise exceptions.Throttled(max(waits, default=None))
+
+    @staticmethod
+    async def authenticate(request):
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2 or auth[0].lower() != b'token':
+            return AnonymousUser()
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        user, _ = await sync_to_async(CachedTokenAuthentication().authenticate_credentials)(key)
+        return user
+
+
+class AsyncProductInfoView(AsyncView):
+    '''Класс для асинхронного поиска товаров'''
+
+    async def get(self, request, *args, **kwargs):
+        '''Поиск товаров методом GET.
+
+        В query string можно передать:
+            shop_id - id магазина,
+            category_id - id категории,
+            page - номер страницы
+
+        '''
+        queryset = get_product_infos(request.GET.get('shop_id'), request.GET.get('category_id')).order_by('id')
+        try:
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            page = 0
+        if page < 1:
+            return JsonResponse({'Status': False, 'Error': 'Invalid page'}, status=404)
+        page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+        count = await queryset.acount()
+        offset = (page - 1) * page_size
+        product_infos = [product_info async for product_info in queryset[offset:offset + page_size]]
+        url = request.build_absolute_uri()
+        return JsonResponse({
+            'count': count,
+            'next': replace_query_param(url, 'page', page + 1) if offset + page_size < count else None,
+            'previous': (None if page == 1 else remove_query_param(url, 'page') if page == 2
+                         else replace_query_param(url, 'page', page - 1)),
+            'results': ProductInfoSerializer(product_infos, many=True).data,
+        })
+
+
+class AsyncBasketView(AsyncView):
+    '''Класс для асинхронного просмотра корзины'''
+
+    async def get(self, request, *args, **kwargs):
+        '''Посмотреть корзину методом GET.
+
+        Необходима авторизация от лица покупателя.
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        if settings.BASKET_STORAGE == 'redis':
+            data = await sync_to_async(RedisBasket(request.user.id).get_data)()
+            return JsonResponse([data], safe=False)
+        basket = [order async for order in get_basket(request.user.id)]
+        return JsonResponse(OrderSerializer(basket, many=True).data, safe=False)
+
+
+class AsyncOrderView(AsyncView):
+    '''Класс для асинхронного просмотра заказов'''
+
+    async def get(self, request, *args, **kwargs):
+        '''Получить заказы пользователя методом GET.
+
+        Необходима авторизация от лица покупателя.
+        Параметры и формат ответа те же, что у OrderView.
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        try:
+            orders = get_orders(request.user.id, request.GET.get('state'),
+                                request.GET.get('dt_from'), request.GET.get('dt_to'))
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Error': str(error)})
+        # CursorPagination синхронная: страница выбирается одним вызовом в потоке ORM
+        paginator = OrderCursorPagination()
+        try:
+            page = await sync_to_async(paginator.paginate_queryset)(orders, Request(request))
+        except exceptions.NotFound as error:
+            return JsonResponse({'detail': str(error.detail)}, status=404)
+        data = OrderSerializer(page, many=True).data
+        return JsonResponse(paginator.get_paginated_response(data).data)
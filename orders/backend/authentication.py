@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from ujson import dumps as dump_json, loads as load_json
+
+from backend.hashers import hash_password, verify_password
+from backend.models import AUTH_USER_FIELDS
+from backend.redis_client import get_redis
+
+UserModel = get_user_model()
+
+
+class LocalCache:
+    '''Ограниченный по размеру LRU-кэш процесса с временем жизни записей'''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+local_cache = LocalCache(settings.AUTH_TOKEN_LOCAL_CACHE_SIZE, settings.AUTH_TOKEN_LOCAL_CACHE_TTL)
+
+
+def get_token_expires(token):
+    '''Время окончания действия токена'''
+    return token.created + timedelta(seconds=settings.AUTH_TOKEN_TTL)
+
+
+def is_token_expired(token):
+    '''Проверка окончания действия токена'''
+    return get_token_expires(token) <= timezone.now()
+
+
+def get_cache_key(key):
+    return f'auth_user:{key}'
+
+
+def invalidate_token(key):
+    '''Удалить токен из кэша процесса и из Redis'''
+    local_cache.delete(key)
+    get_redis().delete(get_cache_key(key))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''Авторизация по токену с кэшированием пользователя.
+
+    Поля пользователя AUTH_USER_FIELDS (без пароля и личных данных) по ключу токена хранятся
+    в LRU-кэше процесса (AUTH_TOKEN_LOCAL_CACHE_TTL) и в Redis (AUTH_TOKEN_CACHE_TTL),
+    к базе данных обращение идет только при промахе кэша. Восстановленный из кэша пользователь
+    содержит только эти поля, полную запись нужно загрузить из базы данных по request.user.id.
+    Токен действует AUTH_TOKEN_TTL секунд с момента создания.
+    Запись удаляется при удалении токена и при изменении этих полей пользователя,
+    другие процессы перестают использовать свою копию по истечении AUTH_TOKEN_LOCAL_CACHE_TTL.
+
+    '''
+
+    def authenticate_credentials(self, key, use_local_cache=True):
+        payload = local_cache.get(key) if use_local_cache else None
+        if payload is None:
+            redis = get_redis()
+            payload = redis.get(get_cache_key(key))
+            if payload is None:
+                user, token = super().authenticate_credentials(key)
+                payload = dump_json({'user': user.get_auth_fields(), 'created': token.created.isoformat()})
+                redis.set(get_cache_key(key), payload, ex=settings.AUTH_TOKEN_CACHE_TTL)
+            local_cache.set(key, payload)
+        return self.load_credentials(key, payload)
+
+    def load_credentials(self, key, payload):
+        '''Восстановить пользователя и токен из кэша'''
+        data = load_json(payload)
+        user = UserModel(**{field: data['user'][field] for field in AUTH_USER_FIELDS})
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        token = self.get_model()(key=key, user=user, created=parse_datetime(data['created']))
+        if is_token_expired(token):
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+        return user, token
+
+
+class PooledModelBackend(ModelBackend):
+    '''Авторизация по логину и паролю с хешированием в пуле потоков backend.hashers'''
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # хеширование выравнивает время ответа для существующих и несуществующих пользователей
+            hash_password(password)
+        else:
+            if verify_password(user, password) and self.user_can_authenticate(user):
+                return user
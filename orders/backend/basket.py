@@ -0,0 +1,145 @@
+from django.conf import settings
+
+from backend.models import Order, OrderItem, ProductInfo
+from backend.redis_client import get_redis
+from backend.serializers import ProductInfoSerializer
+
+
+class RedisBasket:
+    '''Корзина покупателя в Redis.
+
+    Хранится в hash basket:<id пользователя> в формате {id информации о продукте: количество}
+    и переносится в Order/OrderItem только при оформлении заказа.
+
+    '''
+
+    def __init__(self, user_id):
+        self.redis = get_redis()
+        self.user_id = user_id
+        self.key = f'basket:{user_id}'
+        self.ordered = {}
+
+    def get_items(self):
+        '''Получить товары корзины в формате {id информации о продукте: количество}.'''
+        return {int(product_info_id): int(quantity)
+                for product_info_id, quantity in self.redis.hgetall(self.key).items()}
+
+    def get_data(self):
+        '''Получить корзину в том же формате, что и OrderSerializer.'''
+        quantities = self.get_items()
+        product_infos = ProductInfo.objects.filter(id__in=quantities).select_related(
+            'product__category').prefetch_related('product_parameters__parameter')
+        ordered_items = []
+        for product_info, product_info_data in zip(product_infos,
+                                                   ProductInfoSerializer(product_infos, many=True).data):
+            ordered_items.append({
+                'id': product_info.id,
+                'product_info': product_info_data,
+                'quantity': quantities[product_info.id],
+                'price': product_info.price,
+                'shop': product_info.shop_id,
+            })
+        return {
+            'id': None,
+            'ordered_items': ordered_items,
+            'dt': None,
+            'state': 'basket',
+            'total_sum': sum(item['quantity'] * item['price'] for item in ordered_items),
+            'contact': None,
+        }
+
+    def get_summary(self):
+        '''Получить количество позиций, количество единиц товара и сумму корзины.'''
+        quantities = self.get_items()
+        prices = ProductInfo.objects.filter(id__in=quantities).values_list('id', 'price')
+        return {
+            'lines_count': len(quantities),
+            'units_count': sum(quantities.values()),
+            'total_sum': sum(quantities[product_info_id] * price for product_info_id, price in prices),
+        }
+
+    def add(self, quantities, increment=True):
+        '''Добавить товары в корзину.
+
+        Если товар уже есть в корзине, количество суммируется (increment=True) или заменяется.
+
+        '''
+        pipeline = self.redis.pipeline()
+        if increment:
+            for product_info_id, quantity in quantities.items():
+                pipeline.hincrby(self.key, product_info_id, quantity)
+        else:
+            pipeline.hset(self.key, mapping=quantities)
+        pipeline.expire(self.key, settings.BASKET_TTL)
+        pipeline.execute()
+        return len(quantities)
+
+    def update(self, quantities):
+        '''Изменить количество товаров, которые уже есть в корзине.'''
+
+        def set_existing(pipeline):
+            existing = pipeline.hkeys(self.key)
+            mapping = {product_info_id: quantity for product_info_id, quantity in quantities.items()
+                       if str(product_info_id) in existing}
+            pipeline.multi()
+            if mapping:
+                pipeline.hset(self.key, mapping=mapping)
+                pipeline.expire(self.key, settings.BASKET_TTL)
+            return len(mapping)
+
+        return self.redis.transaction(set_existing, self.key, value_from_callable=True)
+
+    def delete(self, product_info_ids):
+        '''Удалить товары из корзины.'''
+        return self.redis.hdel(self.key, *product_info_ids)
+
+    def clear(self):
+        '''Очистить корзину.'''
+        self.redis.delete(self.key)
+
+    def remove(self, quantities):
+        '''Убрать из корзины оформленные товары в формате {id информации о продукте: количество}.
+
+        Товары, добавленные в корзину во время оформления заказа, остаются в ней:
+        удаляются только оформленные позиции, а если количество позиции увеличилось - только оформленное количество.
+
+        '''
+
+        def remove_ordered(pipeline):
+            product_info_ids = list(quantities)
+            current = pipeline.hmget(self.key, product_info_ids)
+            pipeline.multi()
+            for product_info_id, quantity in zip(product_info_ids, current):
+                if quantity is None:
+                    continue
+                if int(quantity) > quantities[product_info_id]:
+                    pipeline.hset(self.key, product_info_id, int(quantity) - quantities[product_info_id])
+                else:
+                    pipeline.hdel(self.key, product_info_id)
+
+        if quantities:
+            self.redis.transaction(remove_ordered, self.key)
+
+    def lock(self):
+        '''Блокировка корзины на время оформления заказа.'''
+        return self.redis.lock(f'{self.key}:checkout', timeout=60, blocking_timeout=10)
+
+    def materialize(self):
+        '''Перенести корзину в Order/OrderItem.
+
+        Вызывается внутри транзакции оформления заказа.
+        Возвращает заказ в статусе "basket" (None для пустой корзины)
+        и список id информации о продуктах, которых больше нет в каталоге.
+        Перенесенные товары сохраняются в ordered для удаления из корзины после оформления.
+
+        '''
+        quantities = self.ordered = self.get_items()
+        if not quantities:
+            return None, []
+        product_infos = ProductInfo.objects.only('price', 'shop_id').in_bulk(quantities)
+        missing = [product_info_id for product_info_id in quantities if product_info_id not in product_infos]
+        basket = Order.objects.create(user_id=self.user_id, state='basket')
+        OrderItem.objects.upsert(basket.id, {product_info_id: quantity for product_info_id, quantity in
+                                             quantities.items() if product_info_id in product_infos},
+                                 product_infos, increment=False)
+        return basket, missing
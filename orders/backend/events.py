@@ -0,0 +1,178 @@
+import asyncio
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+from rest_framework import exceptions
+from ujson import dumps as dump_json
+
+from backend.authentication import CachedTokenAuthentication
+from backend.models import Order, Shop
+from backend.redis_client import get_redis
+
+CHANNEL_PREFIX = 'order_events:'
+
+
+def get_channel(user_id):
+    return f'{CHANNEL_PREFIX}{user_id}'
+
+
+def publish_order_events(events):
+    '''Опубликовать события заказов в Redis.
+
+    events - список пар (id пользователя, данные события).
+    События доставляются только подключенным клиентам, поэтому ошибка Redis не прерывает запрос:
+    клиент после переподключения получает актуальное состояние заказов обычным запросом.
+
+    '''
+    try:
+        with get_redis().pipeline(transaction=False) as pipeline:
+            for user_id, event in events:
+                pipeline.publish(get_channel(user_id), dump_json(event))
+            pipeline.execute()
+    except RedisError:
+        pass
+
+
+def get_order_created_events(order, sub_orders):
+    '''События нового заказа для покупателя и пользователей магазинов'''
+    shop_users = dict(Shop.objects.filter(id__in=[sub_order.shop_id for sub_order in sub_orders]).values_list(
+        'id', 'user_id'))
+    events = [(order.user_id, {'event': 'order_created', 'order_id': order.id, 'state': order.state})]
+    for sub_order in sub_orders:
+        event = {'event': 'order_created', 'order_id': sub_order.id, 'parent_id': order.id, 'state': sub_order.state}
+        events.append((order.user_id, event))
+        if shop_users.get(sub_order.shop_id):
+            events.append((shop_users[sub_order.shop_id], event))
+    return events
+
+
+def get_order_state_events(order_ids, state):
+    '''События изменения статуса заказов для покупателей и пользователей магазинов'''
+    events = []
+    for order_id, parent_id, user_id, shop_user_id in Order.objects.filter(id__in=order_ids).values_list(
+            'id', 'parent_id', 'user_id', 'shop__user_id'):
+        event = {'event': 'order_state_changed', 'order_id': order_id, 'parent_id': parent_id, 'state': state}
+        events.append((user_id, event))
+        if shop_user_id and shop_user_id != user_id:
+            events.append((shop_user_id, event))
+    return events
+
+
+class OrderEventHub:
+    '''Одна подписка Redis на процесс, события раздаются очередям подключенных клиентов'''
+
+    def __init__(self):
+        self.queues = defaultdict(set)
+        self.loop = None
+        self.task = None
+
+    def subscribe(self, user_id):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task.done():
+            self.loop = loop
+            self.task = loop.create_task(self.listen())
+        queue = asyncio.Queue(maxsize=settings.ORDER_EVENTS_QUEUE_SIZE)
+        self.queues[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        self.queues[user_id].discard(queue)
+        if not self.queues[user_id]:
+            del self.queues[user_id]
+
+    async def listen(self):
+        while True:
+            redis = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.psubscribe(f'{CHANNEL_PREFIX}*')
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+                    if message is None:
+                        continue
+                    user_id = int(message['channel'][len(CHANNEL_PREFIX):])
+                    for queue in self.queues.get(user_id, ()):
+                        if not queue.full():
+                            queue.put_nowait(message['data'])
+            except (RedisError, OSError):
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+                await redis.close()
+
+
+hub = OrderEventHub()
+
+
+def get_token_key(scope):
+    '''Ключ токена из заголовка "Authorization: Token <key>" или параметра token в query string'''
+    auth = dict(scope['headers']).get(b'authorization', b'').split()
+    if len(auth) == 2 and auth[0].lower() == b'token':
+        return auth[1].decode(errors='replace')
+    return parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+
+
+async def authenticate(key, use_local_cache=True):
+    '''Пользователь по ключу токена или None, если токен недействителен'''
+    if not key:
+        return None
+    try:
+        user, _ = await sync_to_async(CachedTokenAuthentication().authenticate_credentials)(key, use_local_cache)
+    except exceptions.AuthenticationFailed:
+        return None
+    return user
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def order_events_application(scope, receive, send):
+    '''ASGI-приложение потока событий заказов (server-sent events).
+
+    Покупатель получает события своих заказов, пользователь магазина - события заказов своего магазина:
+        order_created - заказ оформлен,
+        order_state_changed - изменился статус заказа.
+    Пока событий нет, раз в ORDER_EVENTS_HEARTBEAT секунд отправляется комментарий,
+    чтобы соединение не закрывалось прокси. Перед каждым комментарием токен проверяется заново:
+    поток закрывается после удаления или истечения токена и деактивации пользователя.
+
+    '''
+    key = get_token_key(scope)
+    user = await authenticate(key)
+    if user is None:
+        await send({'type': 'http.response.start', 'status': 401,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': b'{"Status": false, "Error": "Log in required"}'})
+        return
+    queue = hub.subscribe(user.id)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': b': connected\n\n', 'more_body': True})
+        while True:
+            event = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({event, disconnected}, timeout=settings.ORDER_EVENTS_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                event.cancel()
+                break
+            if event in done:
+                body = f'event: order\ndata: {event.result()}\n\n'.encode()
+            else:
+                event.cancel()
+                # без кэша процесса: удаление токена в другом процессе видно сразу
+                if await authenticate(key, use_local_cache=False) is None:
+                    await send({'type': 'http.response.body', 'body': b'event: logout\ndata: {}\n\n'})
+                    break
+                body = b': ping\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(user.id, queue)
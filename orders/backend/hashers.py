@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, check_password, make_password
+
+
+class ConfigurablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    '''PBKDF2 с числом итераций из настройки PASSWORD_HASHER_ITERATIONS.
+
+    Пароли, захешированные с другим числом итераций, перехешируются при успешном входе.
+
+    '''
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASHER_ITERATIONS
+
+
+class PasswordHashingBusy(Exception):
+    '''Пул хеширования паролей не успел выполнить задачу'''
+
+
+@lru_cache
+def get_password_executor():
+    return ThreadPoolExecutor(max_workers=settings.PASSWORD_HASHING_WORKERS,
+                              thread_name_prefix='password-hashing')
+
+
+def run_in_pool(func, *args):
+    '''Выполнить хеширование в ограниченном пуле потоков.
+
+    hashlib отпускает GIL на время вычисления, поэтому одновременно хешируется не больше
+    PASSWORD_HASHING_WORKERS паролей, а остальные потоки процесса продолжают обрабатывать запросы.
+
+    '''
+    future = get_password_executor().submit(func, *args)
+    try:
+        return future.result(timeout=settings.PASSWORD_HASHING_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise PasswordHashingBusy
+
+
+def hash_password(password):
+    '''Захешировать пароль в пуле потоков'''
+    return run_in_pool(make_password, password)
+
+
+def hash_passwords(passwords, executor):
+    '''Захешировать несколько паролей параллельно в переданном пуле потоков.
+
+    Пул потоков хеширования процесса для этого не используется, он нужен входу и регистрации.
+
+    '''
+    return list(executor.map(make_password, passwords))
+
+
+def verify_password(user, password):
+    '''Проверить пароль пользователя в пуле потоков.
+
+    При смене алгоритма или числа итераций пароль перехешируется и сохраняется.
+
+    '''
+    must_update = []
+    is_correct = run_in_pool(check_password, password, user.password, must_update.append)
+    if is_correct and must_update:
+        user.password = hash_password(password)
+        user.save(update_fields=['password'])
+    return is_correct
@@ -0,0 +1,77 @@
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from rest_framework.response import Response
+from ujson import dumps as dump_json, loads as load_json
+
+from backend.redis_client import get_redis
+
+IN_PROGRESS = 'in progress'
+# Конфликт и превышение частоты запросов - временные ошибки, повтор с тем же ключом выполняет запрос
+RETRYABLE_STATUSES = (409, 429)
+
+
+def get_fingerprint(request):
+    '''Отпечаток параметров запроса для сравнения повторных запросов с одним ключом.
+
+    Тело запроса JSON может быть не объектом (список, строка, число), оно учитывается целиком.
+
+    '''
+    data = request.data
+    if hasattr(data, 'items'):
+        data = sorted((key, str(value)) for key, value in data.items())
+    return hashlib.sha256(dump_json(data, sort_keys=True).encode()).hexdigest()
+
+
+def idempotent(method):
+    '''Декоратор метода APIView для запросов с заголовком Idempotency-Key.
+
+    Ответ на первый запрос сохраняется в Redis на IDEMPOTENCY_KEY_TTL секунд,
+    повторный запрос с тем же ключом получает сохраненный ответ без выполнения метода.
+    Отметка о выполняемом запросе хранится IDEMPOTENCY_LOCK_TTL секунд: если процесс завершился
+    во время запроса, после этого времени повтор с тем же ключом выполняет запрос.
+    Ответы с кодами 409, 429 и 5xx не сохраняются.
+    Запросы без заголовка и от неавторизованных пользователей выполняются как обычно.
+
+    '''
+
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key or not request.user.is_authenticated:
+            return method(self, request, *args, **kwargs)
+        redis = get_redis()
+        key = f'idempotency:{request.user.id}:{request.method}:{request.path}:{idempotency_key}'
+        fingerprint = get_fingerprint(request)
+        if not redis.set(key, dump_json({'state': IN_PROGRESS, 'fingerprint': fingerprint}),
+                         nx=True, ex=settings.IDEMPOTENCY_LOCK_TTL):
+            saved = load_json(redis.get(key) or '{}')
+            if saved.get('fingerprint') != fingerprint:
+                return JsonResponse({'Status': False, 'Error': 'Idempotency-Key is used with other arguments'},
+                                    status=422)
+            if saved.get('state') == IN_PROGRESS:
+                return JsonResponse({'Status': False, 'Error': 'Request with this Idempotency-Key is in progress'},
+                                    status=409)
+            if 'data' in saved:
+                return Response(saved['data'], status=saved['status'])
+            return HttpResponse(saved['content'], status=saved['status'], content_type=saved['content_type'])
+        try:
+            response = method(self, request, *args, **kwargs)
+        except Exception:
+            redis.delete(key)
+            raise
+        if response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES:
+            redis.delete(key)
+            return response
+        saved = {'fingerprint': fingerprint, 'status': response.status_code}
+        if isinstance(response, Response):
+            saved['data'] = response.data
+        else:
+            saved['content'] = response.content.decode()
+            saved['content_type'] = response['Content-Type']
+        redis.set(key, dump_json(saved), ex=settings.IDEMPOTENCY_KEY_TTL)
+        return response
+
+    return wrapper
@@ -0,0 +1,51 @@
+import threading
+from smtplib import SMTPServerDisconnected
+
+from celery.signals import worker_process_shutdown
+from django.core.mail import get_connection
+from django.core.signals import setting_changed
+
+local = threading.local()
+
+
+def get_mail_connection():
+    '''Открытое соединение с почтовым сервером, общее для всех задач потока воркера'''
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        connection = local.connection = get_connection()
+    connection.open()
+    return connection
+
+
+def close_mail_connection(**kwargs):
+    connection = getattr(local, 'connection', None)
+    if connection is not None:
+        local.connection = None
+        connection.close()
+
+
+def send_messages(messages):
+    '''Отправить письма через постоянное соединение.
+
+    Письма отправляются по одному, чтобы после закрытия соединения сервером (например, по таймауту простоя)
+    продолжить через новое соединение с первого неотправленного письма, не отправляя принятые повторно.
+    Возвращает количество отправленных писем.
+
+    '''
+    sent = 0
+    for message in messages:
+        try:
+            sent += get_mail_connection().send_messages([message]) or 0
+        except SMTPServerDisconnected:
+            close_mail_connection()
+            sent += get_mail_connection().send_messages([message]) or 0
+    return sent
+
+
+def reset_mail_connection(setting, **kwargs):
+    if setting.startswith('EMAIL_'):
+        close_mail_connection()
+
+
+worker_process_shutdown.connect(close_mail_connection)
+setting_changed.connect(reset_mail_connection)
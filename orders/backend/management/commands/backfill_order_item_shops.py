@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from backend.models import OrderItem
+
+
+class Command(BaseCommand):
+    help = 'Заполнение магазина в позициях заказов, созданных до появления поля shop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Количество позиций в одном UPDATE')
+
+    def handle(self, *args, **options):
+        updated = OrderItem.objects.backfill_shops(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} order items'))
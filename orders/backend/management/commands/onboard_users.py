@@ -0,0 +1,32 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.onboarding import read_users_csv, onboard_users
+from backend.tasks import new_users_registered_task
+
+
+class Command(BaseCommand):
+    help = 'Создание пользователей из CSV-файла (first_name, last_name, email, company, position, password)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к CSV-файлу')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Число потоков хеширования паролей')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+                rows = read_users_csv(stream)
+        except (OSError, ValidationError) as e:
+            raise CommandError(e)
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            user_ids, errors = onboard_users(rows, executor)
+        if errors:
+            for line, line_errors in errors.items():
+                self.stderr.write(f'{line}: {line_errors}')
+            raise CommandError('No users created')
+        new_users_registered_task.delay(user_ids=user_ids)
+        self.stdout.write(self.style.SUCCESS(f'Created {len(user_ids)} users'))
@@ -0,0 +1,116 @@
+import time
+
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from backend.redis_client import get_redis
+
+TASK_METRICS_KEY = 'metrics:tasks'
+TASK_METRICS_PREFIX = 'metrics:task:'
+# Границы корзин гистограмм времени ожидания в очереди и выполнения, секунды
+BUCKETS = (0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+started = {}
+
+
+def mark_enqueued(headers=None, **kwargs):
+    '''Записать время постановки задачи в очередь в заголовок сообщения'''
+    if headers is not None:
+        headers['enqueued_at'] = time.time()
+
+
+def get_enqueued_at(request):
+    enqueued_at = getattr(request, 'enqueued_at', None)
+    if enqueued_at is None:
+        enqueued_at = (getattr(request, 'headers', None) or {}).get('enqueued_at')
+    return enqueued_at
+
+
+def observe(pipeline, key, name, value):
+    pipeline.hincrbyfloat(key, f'{name}_sum', value)
+    pipeline.hincrby(key, f'{name}_count', 1)
+    for bucket in BUCKETS:
+        if value <= bucket:
+            pipeline.hincrby(key, f'{name}_bucket_{bucket}', 1)
+
+
+def task_started(task_id=None, task=None, **kwargs):
+    '''Запомнить начало выполнения задачи и записать время ожидания в очереди'''
+    started[task_id] = time.monotonic()
+    enqueued_at = get_enqueued_at(task.request)
+    if enqueued_at is None:
+        return
+    try:
+        with get_redis().pipeline(transaction=False) as pipeline:
+            observe(pipeline, f'{TASK_METRICS_PREFIX}{task.name}', 'wait', max(time.time() - enqueued_at, 0))
+            pipeline.execute()
+    except RedisError:
+        pass
+
+
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    '''Записать время выполнения и результат задачи (SUCCESS, FAILURE, RETRY...)'''
+    start = started.pop(task_id, None)
+    key = f'{TASK_METRICS_PREFIX}{task.name}'
+    try:
+        with get_redis().pipeline(transaction=False) as pipeline:
+            pipeline.sadd(TASK_METRICS_KEY, task.name)
+            pipeline.hincrby(key, f'state_{state}', 1)
+            if start is not None:
+                observe(pipeline, key, 'runtime', time.monotonic() - start)
+            pipeline.execute()
+    except RedisError:
+        pass
+
+
+def get_queue_lengths():
+    '''Количество сообщений в каждой очереди Celery (список Redis с именем очереди)'''
+    names = [queue.name for queue in settings.CELERY_TASK_QUEUES]
+    with get_redis().pipeline(transaction=False) as pipeline:
+        for name in names:
+            pipeline.llen(name)
+        return dict(zip(names, pipeline.execute()))
+
+
+def render_histogram(lines, metric, labels, data, name):
+    for bucket in BUCKETS:
+        lines.append(f'{metric}_bucket{{{labels},le="{bucket}"}} {data.get(f"{name}_bucket_{bucket}", 0)}')
+    count = data.get(f'{name}_count', 0)
+    lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {count}')
+    lines.append(f'{metric}_sum{{{labels}}} {float(data.get(f"{name}_sum", 0))}')
+    lines.append(f'{metric}_count{{{labels}}} {count}')
+
+
+def render_metrics():
+    '''Метрики задач и очередей Celery в текстовом формате Prometheus'''
+    redis = get_redis()
+    tasks = sorted(redis.smembers(TASK_METRICS_KEY))
+    with redis.pipeline(transaction=False) as pipeline:
+        for name in tasks:
+            pipeline.hgetall(f'{TASK_METRICS_PREFIX}{name}')
+        task_data = dict(zip(tasks, pipeline.execute()))
+
+    lines = ['# HELP celery_queue_length Number of messages waiting in the queue.',
+             '# TYPE celery_queue_length gauge']
+    for queue, length in get_queue_lengths().items():
+        lines.append(f'celery_queue_length{{queue="{queue}"}} {length}')
+
+    lines += ['# HELP celery_tasks_total Finished tasks by state.', '# TYPE celery_tasks_total counter']
+    for name, data in task_data.items():
+        for field, value in sorted(data.items()):
+            if field.startswith('state_'):
+                lines.append(f'celery_tasks_total{{task="{name}",state="{field[len("state_"):]}"}} {value}')
+
+    for metric, name, help_text in (
+            ('celery_task_queue_wait_seconds', 'wait', 'Time from publishing to the start of the task.'),
+            ('celery_task_runtime_seconds', 'runtime', 'Task execution time.')):
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+        for task_name, data in task_data.items():
+            render_histogram(lines, metric, f'task="{task_name}"', data, name)
+    return '\n'.join(lines) + '\n'
+
+
+before_task_publish.connect(mark_enqueued)
+task_prerun.connect(task_started)
+task_postrun.connect(task_finished)
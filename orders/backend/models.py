@@ -1,7 +1,12 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
-from django.db import models
+from django.db import models, connections, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 
@@ -16,6 +21,27 @@ STATE_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+STATE_TRANSITIONS = {
+    'basket': ('new',),
+    'new': ('confirmed', 'canceled'),
+    'confirmed': ('assembled', 'canceled'),
+    'assembled': ('sent', 'canceled'),
+    'sent': ('deliveres',),
+    'deliveres': (),
+    'canceled': (),
+}
+
+EMAIL_OUTBOX_KINDS = (
+    ('new_order', 'Новый заказ покупателя'),
+    ('new_sub_order', 'Новый заказ магазина'),
+    ('order_state_changed', 'Новый статус заказа'),
+)
+
+# Статусы оформленного заказа в порядке выполнения
+ORDER_PROGRESS = ('new', 'confirmed', 'assembled', 'sent', 'deliveres')
+
+PARTNER_STATES = ('confirmed', 'assembled', 'sent', 'deliveres', 'canceled')
+
 USER_TYPE_CHOICES = (
     ('shop', 'Магазин'),
     ('buyer', 'Покупатель'),
@@ -53,6 +79,10 @@ class UserManager(BaseUserManager):
         return self._create_user(email, password, **extra_fields)
 
 
+# Поля пользователя, которые кэшируются для авторизации по токену
+AUTH_USER_FIELDS = ('id', 'email', 'type', 'is_active', 'is_staff', 'is_superuser')
+
+
 class User(AbstractUser):
     '''Стандартная модель пользователя'''
     REQUIRED_FIELDS = []
@@ -84,6 +114,25 @@ class User(AbstractUser):
     def __str__(self):
         return f'{self.first_name} {self.last_name}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user.loaded_auth_fields = user.get_auth_fields()
+        return user
+
+    def get_auth_fields(self):
+        '''Значения загруженных полей, которые кэшируются для авторизации по токену.
+
+        Отложенные поля (only, defer) не читаются, иначе каждое из них загружалось бы отдельным запросом.
+
+        '''
+        deferred = self.get_deferred_fields()
+        return {field: getattr(self, field) for field in AUTH_USER_FIELDS if field not in deferred}
+
+    def auth_fields_changed(self):
+        '''Изменились ли кэшируемые поля с момента загрузки из базы данных'''
+        return getattr(self, 'loaded_auth_fields', None) != self.get_auth_fields()
+
     class Meta:
         verbose_name = 'Поьзователь'
         verbose_name_plural = 'Список пользователей'
@@ -220,23 +269,216 @@ class Order(models.Model):
     contact = models.ForeignKey(Contact, verbose_name='Контакт',
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма заказа', default=0)
+    parent = models.ForeignKey('self', verbose_name='Основной заказ', related_name='sub_orders',
+                               blank=True, null=True,
+                               on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='orders',
+                             blank=True, null=True,
+                             on_delete=models.CASCADE)
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = 'Список заказов'
         ordering = ('-dt',)
+        indexes = [
+            models.Index(fields=['user', 'state', 'dt'], name='order_user_state_dt_idx'),
+        ]
 
     def __str__(self):
         return str(self.dt)
 
+    @staticmethod
+    def get_previous_states(state):
+        '''Получить статусы, из которых заказ может перейти в статус state.'''
+        return [previous for previous, next_states in STATE_TRANSITIONS.items() if state in next_states]
+
+    def reserve_items(self):
+        '''Зарезервировать товары заказа на складе.
+
+        Остатки уменьшаются условным UPDATE по каждой позиции в порядке возрастания id информации о продукте,
+        поэтому параллельные заказы блокируют строки в одном порядке и не попадают в deadlock.
+        Вызывается внутри транзакции, которую необходимо откатить, если часть товаров зарезервировать не удалось.
+        Возвращает список id информации о продуктах, которых недостаточно на складе.
+
+        '''
+        unavailable = []
+        ordered_items = self.ordered_items.order_by('product_info_id').values_list('product_info_id', 'quantity')
+        for product_info_id, quantity in ordered_items:
+            is_reserved = ProductInfo.objects.filter(id=product_info_id, quantity__gte=quantity).update(
+                quantity=models.F('quantity') - quantity)
+            if not is_reserved:
+                unavailable.append(product_info_id)
+        return unavailable
+
+    def split_by_shops(self):
+        '''Разделить заказ на заказы по магазинам.
+
+        Для каждого магазина создается заказ с тем же покупателем, статусом и контактом,
+        в который переносятся позиции этого магазина.
+        Возвращает список созданных заказов.
+
+        '''
+        shop_ids = self.ordered_items.order_by('shop_id').values_list('shop_id', flat=True).distinct()
+        sub_orders = Order.objects.bulk_create([
+            Order(user_id=self.user_id, state=self.state, contact_id=self.contact_id, parent=self, shop_id=shop_id)
+            for shop_id in shop_ids
+        ])
+        for sub_order in sub_orders:
+            self.ordered_items.filter(shop_id=sub_order.shop_id).update(order=sub_order)
+            sub_order.update_total_sum()
+        return sub_orders
+
+    @staticmethod
+    def update_parent_states(order_ids):
+        '''Пересчитать статусы основных заказов по статусам их заказов по магазинам.
+
+        Основной заказ получает наименее продвинутый статус среди неотмененных заказов по магазинам,
+        или статус "Отменен", если отменены все. Вызывается в транзакции изменения статусов заказов order_ids.
+
+        '''
+        parent_ids = Order.objects.filter(id__in=order_ids, parent__isnull=False).values('parent_id')
+        sub_order_states = {}
+        for parent_id, state in Order.objects.filter(parent_id__in=parent_ids).values_list('parent_id', 'state'):
+            sub_order_states.setdefault(parent_id, set()).add(state)
+        parent_states = {}
+        for parent_id, states in sub_order_states.items():
+            state = next((state for state in ORDER_PROGRESS if state in states), 'canceled')
+            parent_states.setdefault(state, []).append(parent_id)
+        for state, ids in parent_states.items():
+            Order.objects.filter(id__in=ids).exclude(state=state).update(state=state)
+
+    def update_prices(self):
+        '''Зафиксировать в позициях заказа текущие цены товаров и пересчитать сумму заказа.'''
+        price = ProductInfo.objects.filter(id=models.OuterRef('product_info_id')).values('price')
+        self.ordered_items.update(price=models.Subquery(price))
+        self.update_total_sum()
+
+    def update_total_sum(self):
+        '''Пересчитать сумму заказа по сохраненным ценам позиций.'''
+        Order.update_total_sums([self.id])
+
+    @staticmethod
+    def update_total_sums(order_ids):
+        '''Пересчитать суммы заказов order_ids одним запросом по сохраненным ценам позиций.'''
+        total_sum = OrderItem.objects.filter(order_id=models.OuterRef('id')).values('order_id').annotate(
+            total_sum=models.Sum(models.F('quantity') * models.F('price'))).values('total_sum')
+        Order.objects.filter(id__in=order_ids).update(total_sum=Coalesce(models.Subquery(total_sum), 0))
+
+
+class OrderItemManager(models.Manager):
+    '''Менеджер для работы с позициями в заказе'''
+
+    def bulk_create(self, objs, *args, **kwargs):
+        '''Создать позиции, заполнив магазин по информации о продукте одним запросом'''
+        objs = list(objs)
+        product_info_ids = {obj.product_info_id for obj in objs if obj.shop_id is None}
+        if product_info_ids:
+            shop_ids = dict(ProductInfo.objects.filter(id__in=product_info_ids).values_list('id', 'shop_id'))
+            for obj in objs:
+                if obj.shop_id is None:
+                    obj.shop_id = shop_ids.get(obj.product_info_id)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def backfill_shops(self, batch_size=1000):
+        '''Заполнить магазин в позициях, созданных без него, пачками по batch_size.
+
+        Возвращает количество обновленных позиций.
+
+        '''
+        shop_id = ProductInfo.objects.filter(id=models.OuterRef('product_info_id')).values('shop_id')
+        updated = 0
+        while True:
+            ids = list(self.filter(shop__isnull=True, product_info__shop__isnull=False).values_list(
+                'id', flat=True)[:batch_size])
+            if not ids:
+                return updated
+            self.filter(id__in=ids).update(shop_id=models.Subquery(shop_id))
+            updated += len(ids)
+
+    def backfill_prices(self, batch_size=1000):
+        '''Заполнить цены позиций, созданных до их сохранения, и пересчитать суммы их заказов.
+
+        Позиции без цены выбираются пачками по batch_size по возрастанию id, каждая пачка
+        начинается после последней обработанной позиции. Цена берется из информации о продукте.
+        Возвращает количество обновленных позиций.
+
+        '''
+        price = ProductInfo.objects.filter(id=models.OuterRef('product_info_id')).values('price')
+        updated, last_id = 0, 0
+        while True:
+            items = list(self.filter(id__gt=last_id, price=0).order_by('id').values_list(
+                'id', 'order_id')[:batch_size])
+            if not items:
+                return updated
+            with transaction.atomic():
+                self.filter(id__in=[item_id for item_id, _ in items]).update(price=models.Subquery(price))
+                Order.update_total_sums({order_id for _, order_id in items})
+            updated += len(items)
+            last_id = items[-1][0]
+
+    def upsert(self, order_id, quantities, product_infos, increment=True):
+        '''Добавить позиции в заказ одним запросом INSERT ... ON CONFLICT.
+
+        quantities - словарь {id информации о продукте: количество},
+        product_infos - словарь {id информации о продукте: ProductInfo} с текущими ценами и магазинами.
+        Если позиция уже есть в заказе, количество суммируется (increment=True) или заменяется,
+        цена обновляется на текущую.
+
+        '''
+        if not quantities:
+            return 0
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        order_column = quote(self.model._meta.get_field('order').column)
+        product_info_column = quote(self.model._meta.get_field('product_info').column)
+        quantity_column = quote(self.model._meta.get_field('quantity').column)
+        price_column = quote(self.model._meta.get_field('price').column)
+        shop_column = quote(self.model._meta.get_field('shop').column)
+        if increment:
+            quantity = f'{table}.{quantity_column} + EXCLUDED.{quantity_column}'
+        else:
+            quantity = f'EXCLUDED.{quantity_column}'
+        values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(quantities))
+        params = []
+        for product_info_id, item_quantity in quantities.items():
+            product_info = product_infos[product_info_id]
+            params.extend([order_id, product_info_id, item_quantity, product_info.price, product_info.shop_id])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} '
+                f'({order_column}, {product_info_column}, {quantity_column}, {price_column}, {shop_column}) '
+                f'VALUES {values} '
+                f'ON CONFLICT ({order_column}, {product_info_column}) '
+                f'DO UPDATE SET {quantity_column} = {quantity}, {price_column} = EXCLUDED.{price_column}',
+                params)
+        return len(quantities)
+
+    def release(self, order_ids):
+        '''Вернуть на склад товары из позиций заказов.
+
+        Остатки увеличиваются в порядке возрастания id информации о продукте, как и при резервировании.
+
+        '''
+        quantities = self.filter(order_id__in=order_ids).values('product_info_id').annotate(
+            total_quantity=models.Sum('quantity')).order_by('product_info_id')
+        for item in quantities:
+            ProductInfo.objects.filter(id=item['product_info_id']).update(
+                quantity=models.F('quantity') + item['total_quantity'])
+
 
 class OrderItem(models.Model):
     '''Модель позиций в заказе'''
+    objects = OrderItemManager()
     order = models.ForeignKey(Order, verbose_name='Заказ', related_name='ordered_items', blank=True,
                               on_delete=models.CASCADE)
     product_info = models.ForeignKey(ProductInfo, verbose_name='О продукте', related_name='ordered_items',
                                      blank=True, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(verbose_name='Колиество')
+    price = models.PositiveIntegerField(verbose_name='Цена', default=0)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='ordered_items', blank=True, null=True,
+                             on_delete=models.CASCADE)
 
     class Meta:
         verbose_name = 'Заказанная позиция'
@@ -244,6 +486,14 @@ class OrderItem(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['order_id', 'product_info'], name='unique_order_item'),
         ]
+        indexes = [
+            models.Index(fields=['shop', 'order'], name='order_item_shop_order_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.shop_id is None and self.product_info_id is not None:
+            self.shop_id = self.product_info.shop_id
+        super().save(*args, **kwargs)
 
 
 class ConfirmEmailToken(models.Model):
@@ -262,10 +512,18 @@ class ConfirmEmailToken(models.Model):
         on_delete=models.CASCADE,
         verbose_name=_('The user which is associated to this token')
     )
-    created_at = models.DateTimeField(auto_now_add=True,
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True,
                                       verbose_name=_('When this token was generated'))
     key = models.CharField(_('Key'), max_length=64, db_index=True, unique=True)
 
+    @staticmethod
+    def get_expired_dt():
+        '''Время создания, раньше которого токены считаются истекшими'''
+        return timezone.now() - timedelta(seconds=settings.CONFIRM_EMAIL_TOKEN_TTL)
+
+    def is_expired(self):
+        return self.created_at < self.get_expired_dt()
+
     def save(self, *args, **kwargs):
         if not self.key:
             self.key = self.generate_key()
@@ -273,3 +531,50 @@ class ConfirmEmailToken(models.Model):
 
     def __str__(self):
         return f'Password reset token for user {self.user}'
+
+
+class EmailOutboxManager(models.Manager):
+    '''Менеджер исходящих уведомлений'''
+
+    def add(self, kind, order_ids, state='', delay=0):
+        '''Добавить уведомления о заказах в текущей транзакции.
+
+        Уведомление того же типа о том же заказе и статусе повторно не добавляется.
+        delay - через сколько секунд уведомление можно отправлять.
+
+        '''
+        next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        self.bulk_create([self.model(kind=kind, order_id=order_id, state=state, next_attempt_at=next_attempt_at)
+                          for order_id in order_ids], ignore_conflicts=True)
+
+
+class EmailOutbox(models.Model):
+    '''Модель исходящего уведомления.
+
+    Записывается в одной транзакции с изменением заказа и отправляется задачей send_outbox_emails_task.
+
+    '''
+    objects = EmailOutboxManager()
+    kind = models.CharField(verbose_name='Тип', choices=EMAIL_OUTBOX_KINDS, max_length=30)
+    order = models.ForeignKey(Order, verbose_name='Заказ', related_name='emails', on_delete=models.CASCADE)
+    state = models.CharField(verbose_name='Статус заказа', choices=STATE_CHOICES, max_length=15, blank=True)
+    created_at = models.DateTimeField(verbose_name='Создано', auto_now_add=True)
+    next_attempt_at = models.DateTimeField(verbose_name='Следующая попытка', default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(verbose_name='Попыток', default=0)
+    sent_at = models.DateTimeField(verbose_name='Отправлено', null=True, blank=True)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+
+    class Meta:
+        verbose_name = 'Исходящее уведомление'
+        verbose_name_plural = 'Исходящие уведомления'
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'order', 'state'], name='unique_email_outbox'),
+        ]
+        indexes = [
+            models.Index(fields=['next_attempt_at'], condition=models.Q(sent_at__isnull=True),
+                         name='email_outbox_pending_idx'),
+            models.Index(fields=['sent_at'], name='email_outbox_sent_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.order_id}'
@@ -0,0 +1,76 @@
+import csv
+
+from django.contrib.auth.password_validation import validate_password
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+
+from backend.hashers import hash_passwords
+from backend.models import User
+
+ONBOARDING_FIELDS = ('first_name', 'last_name', 'email', 'company', 'position', 'password')
+
+
+def read_users_csv(stream):
+    '''Прочитать строки CSV с заголовком ONBOARDING_FIELDS'''
+    reader = csv.DictReader(stream)
+    missing = set(ONBOARDING_FIELDS) - set(reader.fieldnames or ())
+    if missing:
+        raise ValidationError(f'Missing columns: {", ".join(sorted(missing))}')
+    return list(reader)
+
+
+def validate_users(rows):
+    '''Проверить строки CSV без запросов к базе данных для каждой строки.
+
+    Возвращает список несохраненных пользователей, список паролей и ошибки по номерам строк файла.
+
+    '''
+    users, passwords, errors = [], [], {}
+    emails = set()
+    for line, row in enumerate(rows, start=2):
+        user = User(**{field: (row.get(field) or '').strip() for field in ONBOARDING_FIELDS if field != 'password'})
+        password = row.get('password') or ''
+        line_errors = {}
+        try:
+            user.clean_fields(exclude=['password', 'username'])
+        except ValidationError as e:
+            line_errors.update(e.message_dict)
+        try:
+            validate_password(password, user)
+        except ValidationError as e:
+            line_errors['password'] = e.messages
+        if user.email in emails:
+            line_errors.setdefault('email', []).append('Duplicate email in file')
+        emails.add(user.email)
+        if line_errors:
+            errors[line] = line_errors
+        users.append(user)
+        passwords.append(password)
+
+    existing = set(User.objects.filter(email__in=emails).values_list('email', flat=True))
+    for line, user in enumerate(users, start=2):
+        if user.email in existing:
+            errors.setdefault(line, {}).setdefault('email', []).append('User with this email already exists')
+    return users, passwords, errors
+
+
+def onboard_users(rows, executor):
+    '''Создать пользователей из строк CSV.
+
+    Пароли хешируются в переданном пуле потоков, пользователи создаются одним bulk_create
+    только если все строки корректны.
+    Возвращает список id созданных пользователей и ошибки по номерам строк файла.
+
+    '''
+    users, passwords, errors = validate_users(rows)
+    if errors:
+        return [], errors
+    for user, password in zip(users, hash_passwords(passwords, executor)):
+        user.password = password
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create(users, batch_size=500)
+    except IntegrityError:
+        return [], {'email': 'User with this email already exists'}
+    user_ids = list(User.objects.filter(email__in=[user.email for user in users]).values_list('id', flat=True))
+    return user_ids, {}
@@ -0,0 +1,10 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OrderCursorPagination(CursorPagination):
+    '''Постраничный вывод заказов от новых к старым.
+
+    Страница выбирается по курсору на поле dt, поэтому не требует подсчета всех заказов и OFFSET.
+
+    '''
+    ordering = '-dt'
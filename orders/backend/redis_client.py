@@ -0,0 +1,10 @@
+from functools import lru_cache
+
+from django.conf import settings
+from redis import Redis
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    '''Общий клиент Redis с пулом соединений на процесс'''
+    return Redis.from_url(settings.REDIS_URL, decode_responses=True)
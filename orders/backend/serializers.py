@@ -77,8 +77,8 @@ class OrderItemSerializer(serializers.ModelSerializer):
     '''Сериализатор модели OrderItem'''
     class Meta:
         model = OrderItem
-        fields = ('id', 'product_info', 'quantity', 'order',)
-        read_only_fields = ('id',)
+        fields = ('id', 'product_info', 'quantity', 'price', 'order',)
+        read_only_fields = ('id', 'price',)
         extra_kwargs = {
             'order': {'write_only': True}
         }
@@ -93,13 +93,35 @@ class OrderItemCreateSerializer(serializers.ModelSerializer):
         fields = ("__all__")
 
 
+class SubOrderSerializer(serializers.ModelSerializer):
+    '''Сериализатор модели Order для заказов по магазинам'''
+    ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
+
+    class Meta:
+        model = Order
+        fields = ('id', 'shop', 'ordered_items', 'state', 'total_sum')
+        read_only_fields = ('id',)
+
+
 class OrderSerializer(serializers.ModelSerializer):
     '''Сериализатор модели Order'''
     ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
-    total_sum = serializers.IntegerField()
+    sub_orders = SubOrderSerializer(read_only=True, many=True)
     contact = ContactSerializer(read_only=True)
 
     class Meta:
         model = Order
-        fields = ('id', 'ordered_items', 'dt', 'state', 'total_sum', 'contact')
+        fields = ('id', 'ordered_items', 'sub_orders', 'dt', 'state', 'total_sum', 'contact')
         read_only_field = ('id',)
+
+
+class PartnerOrderSerializer(serializers.ModelSerializer):
+    '''Сериализатор модели Order для поставщика'''
+    ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
+    shop_sum = serializers.IntegerField(read_only=True)
+    contact = ContactSerializer(read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ('id', 'ordered_items', 'dt', 'state', 'shop_sum', 'contact')
+        read_only_fields = ('id',)
@@ -1,3 +1,46 @@
+from django.db import connections
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from backend.authentication import invalidate_token
+from backend.models import User, AUTH_USER_FIELDS
+
+
+@receiver(post_migrate)
+def token_created_index_signal(app_config, using, **kwargs):
+    '''Индекс по времени создания токена для удаления истекших токенов пачками.
+
+    Модель Token принадлежит rest_framework.authtoken, поэтому индекс создается после ее миграций.
+
+    '''
+    if app_config.label != 'authtoken':
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS authtoken_token_created_idx '
+                       f'ON {connection.ops.quote_name(Token._meta.db_table)} '
+                       f'({connection.ops.quote_name("created")})')
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted_signal(instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def user_saved_signal(instance, created, update_fields=None, **kwargs):
+    if created:
+        return
+    if update_fields is not None and not set(update_fields) & set(AUTH_USER_FIELDS):
+        return
+    if not instance.auth_fields_changed():
+        return
+    instance.loaded_auth_fields = instance.get_auth_fields()
+    for key in Token.objects.filter(user_id=instance.id).values_list('key', flat=True):
+        invalidate_token(key)
+
+
 # from django.conf import settings
 # from django.core.mail import EmailMultiAlternatives
 # from django.dispatch import Signal, receiver
@@ -1,8 +1,123 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from celery import shared_task
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from requests import get
+from requests.exceptions import RequestException
+from rest_framework.authtoken.models import Token
+from ujson import dumps as dump_json, loads as load_json
+from yaml import load as load_yaml, Loader, YAMLError
+
+from backend.mail import send_messages
+from backend.onboarding import onboard_users
+from backend.redis_client import get_redis
+from backend.models import ConfirmEmailToken, User, EmailOutbox, Shop, Category, Product, ProductInfo, Parameter, \
+    ProductParameter, OrderItem, STATE_CHOICES
+
+
+# Ошибки скачивания и содержимого файла прайса
+PRICE_LIST_ERRORS = (RequestException, YAMLError, KeyError, TypeError, ValueError, IntegrityError)
+
+
+def get_import_status_key(task_id):
+    return f'partner_import:{task_id}'
+
+
+def set_import_status(task_id, user_id, state, error=''):
+    '''Сохранить статус загрузки прайса: queued, started, success или failed с текстом ошибки'''
+    with get_redis().pipeline() as pipeline:
+        pipeline.hset(get_import_status_key(task_id), mapping={'user_id': user_id, 'state': state, 'error': error})
+        pipeline.expire(get_import_status_key(task_id), settings.PARTNER_IMPORT_STATUS_TTL)
+        pipeline.execute()
+
+
+def get_import_status(task_id):
+    '''Статус загрузки прайса или None, если задача неизвестна или статус устарел'''
+    return get_redis().hgetall(get_import_status_key(task_id)) or None
+
+
+def get_onboarding_rows_key(task_id):
+    return f'onboarding_rows:{task_id}'
+
+
+def set_onboarding_rows(task_id, rows):
+    '''Сохранить строки CSV с паролями для задачи регистрации на ONBOARDING_ROWS_TTL секунд.
+
+    Пароли не передаются в сообщении задачи и не остаются в брокере и в отчетах об ошибках задач.
+
+    '''
+    get_redis().set(get_onboarding_rows_key(task_id), dump_json(rows), ex=settings.ONBOARDING_ROWS_TTL)
+
+
+def load_price_list(url):
+    '''Скачать и разобрать файл прайса поставщика'''
+    response = get(url, timeout=settings.PARTNER_IMPORT_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    data = load_yaml(response.content, Loader=Loader)
+    if not isinstance(data, dict) or not {'shop', 'categories', 'goods'}.issubset(data):
+        raise ValueError('File must contain shop, categories and goods')
+    return data
+
+
+def import_price_list(user_id, data):
+    '''Обновить товары магазина по прайсу.
+
+    Информация о товаре обновляется на месте по внешнему id, поэтому позиции размещенных заказов
+    и корзин продолжают ссылаться на нее. Товары, которых нет в прайсе, удаляются,
+    а если они есть в размещенных заказах - остаются с нулевым количеством.
+
+    '''
+    with transaction.atomic():
+        shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=user_id)
+        for category in data['categories']:
+            category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
+            category_object.shops.add(shop.id)
+            category_object.save()
+        product_infos = {product_info.external_id: product_info
+                         for product_info in ProductInfo.objects.select_for_update().filter(shop_id=shop.id)}
+        external_ids = set()
+        for item in data['goods']:
+            product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
+            fields = {'product_id': product.id, 'model': item['model'], 'price': item['price'],
+                      'price_rrc': item['price_rrc'], 'quantity': item['quantity']}
+            product_info = product_infos.get(item['id'])
+            if product_info is None:
+                product_info = ProductInfo.objects.create(external_id=item['id'], shop_id=shop.id, **fields)
+            else:
+                ProductInfo.objects.filter(id=product_info.id).update(**fields)
+                ProductParameter.objects.filter(product_info_id=product_info.id).delete()
+            external_ids.add(item['id'])
+            for name, value in item['parameters'].items():
+                parameter_object, _ = Parameter.objects.get_or_create(name=name)
+                ProductParameter.objects.create(product_info_id=product_info.id,
+                                                parameter_id=parameter_object.id,
+                                                value=value)
+        removed = ProductInfo.objects.filter(shop_id=shop.id).exclude(external_id__in=external_ids)
+        ordered_ids = OrderItem.objects.exclude(order__state='basket').values('product_info_id')
+        removed.filter(id__in=ordered_ids).update(quantity=0)
+        removed.exclude(id__in=ordered_ids).delete()
+
 
-from backend.models import ConfirmEmailToken, User
+@shared_task(bind=True, acks_late=True)
+def partner_update_task(self, user_id, url):
+    task_id = self.request.id
+    if task_id:
+        set_import_status(task_id, user_id, 'started')
+    try:
+        import_price_list(user_id, load_price_list(url))
+    except Exception as error:
+        if task_id:
+            set_import_status(task_id, user_id, 'failed', f'{type(error).__name__}: {error}')
+        # ошибка в файле поставщика сохранена для него в статусе, повтор задачи не поможет
+        if not isinstance(error, PRICE_LIST_ERRORS):
+            raise
+    else:
+        if task_id:
+            set_import_status(task_id, user_id, 'success')
 
 
 @shared_task()
@@ -15,17 +130,169 @@ def new_user_registered_task(user_id, **kwargs):
         settings.EMAIL_HOST_USER,
         [token.user.email]
     )
-    msg.send()
+    send_messages([msg])
 
 
 @shared_task()
-def new_order_task(user_id, **kwargs):
-    user = User.objects.filter(id=user_id).first()
+def new_users_registered_task(user_ids, **kwargs):
+    users = User.objects.filter(id__in=user_ids).exclude(confirm_email_token__isnull=False)
+    ConfirmEmailToken.objects.bulk_create([ConfirmEmailToken(user=user, key=ConfirmEmailToken.generate_key())
+                                           for user in users])
+    tokens = ConfirmEmailToken.objects.filter(user_id__in=user_ids).select_related('user')
+    messages = [
+        EmailMultiAlternatives(
+            f'Confirm email token for {token.user.email}',
+            f'{token.key}',
+            settings.EMAIL_HOST_USER,
+            [token.user.email]
+        )
+        for token in tokens
+    ]
+    send_messages(messages)
 
-    msg = EmailMultiAlternatives(
+
+@shared_task(bind=True, acks_late=True)
+def onboard_users_task(self, user_id):
+    '''Создать пользователей из строк CSV, проверенных при загрузке файла сотрудником user_id.
+
+    Строки читаются из Redis по id задачи (set_onboarding_rows) и удаляются после выполнения.
+    Пароли хешируются в собственном пуле потоков задачи.
+    Статус задачи хранится так же, как статус загрузки прайса, ошибки строк - в тексте ошибки.
+
+    '''
+    task_id = self.request.id
+    rows_key = get_onboarding_rows_key(task_id)
+    rows = get_redis().get(rows_key)
+    if rows is None:
+        set_import_status(task_id, user_id, 'failed', 'File rows have expired')
+        return
+    set_import_status(task_id, user_id, 'started')
+    try:
+        with ThreadPoolExecutor(max_workers=settings.ONBOARDING_HASHING_WORKERS,
+                                thread_name_prefix='onboarding-hashing') as executor:
+            user_ids, errors = onboard_users(load_json(rows), executor)
+    finally:
+        get_redis().delete(rows_key)
+    if errors:
+        set_import_status(task_id, user_id, 'failed', dump_json(errors))
+        return
+    new_users_registered_task.delay(user_ids=user_ids)
+    set_import_status(task_id, user_id, 'success')
+
+
+def group_outbox_items(items):
+    '''Разбить уведомления на группы, каждая группа отправляется одним письмом.
+
+    Новые заказы магазинов объединяются по пользователю магазина,
+    остальные уведомления отправляются по одному.
+
+    '''
+    groups, shop_groups = [], {}
+    for item in items:
+        shop = item.order.shop
+        if item.kind == 'new_sub_order' and shop is not None and shop.user_id is not None:
+            shop_groups.setdefault(shop.user_id, []).append(item)
+        else:
+            groups.append([item])
+    return groups + list(shop_groups.values())
+
+
+def get_outbox_messages(items):
+    '''Письма группы исходящих уведомлений'''
+    order = items[0].order
+    if items[0].kind == 'new_sub_order':
+        if order.shop is None or order.shop.user is None:
+            return []
+        parts = []
+        for item in items:
+            lines = [
+                f'{order_item.product_info.product.name} ({order_item.product_info.model}): '
+                f'{order_item.quantity} x {order_item.price}'
+                for order_item in item.order.ordered_items.all()
+            ]
+            parts.append('\n'.join([f'Заказ №{item.order.id}'] + lines + [f'Сумма: {item.order.total_sum}']))
+        return [EmailMultiAlternatives(
+            f'Новый заказ №{order.id}' if len(items) == 1 else f'Новые заказы: {len(items)}',
+            '\n\n'.join(parts),
+            settings.EMAIL_HOST_USER,
+            [order.shop.user.email]
+        )]
+    if items[0].kind == 'new_order':
+        body = 'Заказ передан поставщику'
+    else:
+        body = f'Заказ №{order.id}: {dict(STATE_CHOICES)[items[0].state]}'
+    return [EmailMultiAlternatives(
         'Новый статус заказа',
-        'Заказ передан поставщику',
+        body,
         settings.EMAIL_HOST_USER,
-        [user.email]
-    )
-    msg.send()
+        [order.user.email]
+    )]
+
+
+def get_pending_outbox():
+    '''Неотправленные уведомления, заблокированные для текущей транзакции'''
+    return EmailOutbox.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+        sent_at__isnull=True, attempts__lt=settings.EMAIL_OUTBOX_MAX_ATTEMPTS).select_related(
+        'order__user', 'order__shop__user').prefetch_related('order__ordered_items__product_info__product')
+
+
+@shared_task()
+def send_outbox_emails_task(**kwargs):
+    batch_size = settings.EMAIL_OUTBOX_BATCH_SIZE
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            items = list(get_pending_outbox().filter(next_attempt_at__lte=now).order_by('next_attempt_at')[:batch_size])
+            # окно PARTNER_NOTIFICATION_WINDOW отсчитывается от первого заказа: вместе с ним отправляются
+            # еще не подошедшие по времени новые заказы того же пользователя магазина
+            shop_user_ids = {item.order.shop.user_id for item in items
+                             if item.kind == 'new_sub_order' and item.order.shop is not None}
+            early_items = list(get_pending_outbox().filter(
+                kind='new_sub_order', attempts=0, next_attempt_at__gt=now,
+                order__shop__user_id__in=shop_user_ids)) if shop_user_ids else []
+            items += early_items
+            for group in group_outbox_items(items):
+                try:
+                    send_messages(get_outbox_messages(group))
+                except Exception as error:
+                    for item in group:
+                        item.attempts += 1
+                        item.error = str(error)
+                        item.next_attempt_at = now + timedelta(
+                            seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (item.attempts - 1))
+                else:
+                    for item in group:
+                        item.sent_at = now
+            EmailOutbox.objects.bulk_update(items, ['attempts', 'error', 'next_attempt_at', 'sent_at'])
+        if len(items) - len(early_items) < batch_size:
+            break
+    sent_ids = EmailOutbox.objects.filter(
+        sent_at__lt=timezone.now() - timedelta(seconds=settings.EMAIL_OUTBOX_RETENTION)).values_list('id', flat=True)
+    EmailOutbox.objects.filter(id__in=list(sent_ids[:batch_size])).delete()
+
+
+@shared_task()
+def delete_expired_tokens_task(**kwargs):
+    expired = timezone.now() - timedelta(seconds=settings.AUTH_TOKEN_TTL)
+    while True:
+        keys = list(Token.objects.filter(created__lt=expired).order_by('created').values_list(
+            'key', flat=True)[:settings.AUTH_TOKEN_CLEANUP_BATCH_SIZE])
+        if not keys:
+            break
+        Token.objects.filter(key__in=keys).delete()
+
+
+@shared_task()
+def delete_expired_confirm_email_tokens_task(**kwargs):
+    expired = ConfirmEmailToken.get_expired_dt()
+    # пачки выбираются по индексу created_at, обработанные токены удаляются, поэтому каждая пачка начинается
+    # с начала индекса без повторного просмотра; удаляются только пользователи с истекшим токеном
+    while True:
+        tokens = list(ConfirmEmailToken.objects.filter(created_at__lt=expired).order_by('created_at').values_list(
+            'id', 'user_id')[:settings.CONFIRM_EMAIL_TOKEN_CLEANUP_BATCH_SIZE])
+        if not tokens:
+            break
+        with transaction.atomic():
+            ConfirmEmailToken.objects.filter(id__in=[token_id for token_id, _ in tokens]).delete()
+            User.objects.filter(id__in={user_id for _, user_id in tokens}, is_active=False).exclude(
+                confirm_email_token__created_at__gte=expired).delete()
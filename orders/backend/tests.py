@@ -1,16 +1,58 @@
+import asyncio
+import json
 import random
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from pathlib import Path
 from random import choice
 from string import ascii_letters
+from tempfile import NamedTemporaryFile
+from unittest.mock import patch
+from uuid import uuid4
 import factory
 import factory.django
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from factory.fuzzy import FuzzyInteger
+from faker import Faker
 from rest_framework.authtoken.models import Token
-from rest_framework.test import APITestCase
-
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APITestCase, APIClient, APIRequestFactory
+
+from backend.authentication import CachedTokenAuthentication, get_cache_key
+from backend.basket import RedisBasket
+from backend.metrics import TASK_METRICS_KEY, TASK_METRICS_PREFIX
+from backend.events import get_channel, hub, order_events_application, publish_order_events
+from backend.idempotency import get_fingerprint
+from backend.redis_client import get_redis
+from backend.async_views import AsyncView
+from backend.throttling import AnonRateThrottle, UserRateThrottle
+from backend.views import MetricsView
+from backend.tasks import delete_expired_tokens_task, delete_expired_confirm_email_tokens_task, \
+    new_users_registered_task, onboard_users_task, send_outbox_emails_task, partner_update_task, get_import_status, \
+    get_onboarding_rows_key
+from orders.celery import app as celery_app
 from backend.models import User, ConfirmEmailToken, Category, Shop, Product, ProductInfo, Parameter, ProductParameter, \
-    Contact, Order, OrderItem
+    Contact, Order, OrderItem, EmailOutbox
+
+fake = Faker()
 
 
 def generate_random_string(len):
@@ -31,12 +73,12 @@ class UserFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = User
 
-    email = factory.Faker('email')
+    email = factory.LazyFunction(lambda: fake.unique.email())
     password = factory.Faker('password')
     first_name = factory.Faker('first_name')
     last_name = factory.Faker('last_name')
-    company = factory.Faker('company')
-    position = factory.Faker('job')
+    company = factory.LazyFunction(lambda: fake.company()[:50])
+    position = factory.LazyFunction(lambda: fake.job()[:50])
 
 
 class ShopFactory(factory.django.DjangoModelFactory):
@@ -45,7 +87,7 @@ class ShopFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = Shop
 
-    name = factory.Faker('company')
+    name = factory.LazyFunction(lambda: fake.company()[:50])
     url = factory.Faker('url')
     user = factory.SubFactory(UserFactory)
     state = True
@@ -151,6 +193,8 @@ class OrderItemFactory(factory.django.DjangoModelFactory):
     order = factory.SubFactory(OrderFactory)
     product_info = factory.SubFactory(ProductInfoFactory)
     quantity = FuzzyInteger(1, 10)
+    price = factory.LazyAttribute(lambda order_item: order_item.product_info.price)
+    shop = factory.LazyAttribute(lambda order_item: order_item.product_info.shop)
 
 
 class RegisterAccountTests(APITestCase):
@@ -238,6 +282,97 @@ class RegisterAccountTests(APITestCase):
         assert User.objects.filter(email=data['email']).first() is None
 
 
+@override_settings(PASSWORD_HASHER_ITERATIONS=1000)
+class UserOnboardingTests(APITestCase):
+    '''Класс тестирования массовой регистрации пользователей из CSV'''
+
+    url = reverse('backend:user-onboarding')
+
+    def setUp(self):
+        self.user = UserFactory.create(is_staff=True)
+        log_in_user(self.user, self.client)
+
+    def make_csv(self, rows):
+        lines = ['first_name,last_name,email,company,position,password']
+        lines += [','.join(row) for row in rows]
+        return SimpleUploadedFile('users.csv', '\n'.join(lines).encode())
+
+    def make_row(self):
+        return [fake.first_name(), fake.last_name(), fake.unique.email(), 'Company', 'Manager', 'Password-123']
+
+    def test_onboarding(self):
+        '''Тест успешной регистрации пользователей из CSV'''
+        rows = [self.make_row() for _ in range(5)]
+        response = self.client.post(self.url, {'file': self.make_csv(rows)})
+        task_id = response.json()['Task']
+        assert self.client.get(self.url, {'task': task_id}).json()['State'] == 'queued'
+        users = User.objects.filter(email__in=[row[2] for row in rows])
+        assert not users.exists()
+        assert get_redis().exists(get_onboarding_rows_key(task_id))
+        onboard_users_task.apply(kwargs={'user_id': self.user.id}, task_id=task_id)
+        assert self.client.get(self.url, {'task': task_id}).json()['State'] == 'success'
+        assert not get_redis().exists(get_onboarding_rows_key(task_id))
+        assert users.count() == 5
+        assert all(user.check_password('Password-123') and not user.is_active for user in users)
+
+    def test_onboarding_task_failed(self):
+        '''Тест сохранения ошибок строк, появившихся после загрузки файла'''
+        row = self.make_row()
+        response = self.client.post(self.url, {'file': self.make_csv([row])})
+        task_id = response.json()['Task']
+        UserFactory.create(email=row[2])
+        onboard_users_task.apply(kwargs={'user_id': self.user.id}, task_id=task_id)
+        response = self.client.get(self.url, {'task': task_id})
+        assert response.json()['State'] == 'failed'
+        assert json.loads(response.json()['Error']) == {'2': {'email': ['User with this email already exists']}}
+
+    def test_onboarding_passwords_not_in_task_message(self):
+        '''Тест передачи строк файла задаче через Redis, без паролей в сообщении задачи'''
+        row = self.make_row()
+        with patch.object(onboard_users_task, 'apply_async') as apply_async:
+            response = self.client.post(self.url, {'file': self.make_csv([row])})
+        assert apply_async.call_args.kwargs['kwargs'] == {'user_id': self.user.id}
+        task_id = response.json()['Task']
+        get_redis().delete(get_onboarding_rows_key(task_id))
+        onboard_users_task.apply(kwargs={'user_id': self.user.id}, task_id=task_id)
+        response = self.client.get(self.url, {'task': task_id})
+        assert response.json() == {'Status': True, 'State': 'failed', 'Error': 'File rows have expired'}
+        assert not User.objects.filter(email=row[2]).exists()
+
+    def test_onboarding_invalid_rows(self):
+        '''Тест регистрации из CSV с ошибками: пользователи не создаются'''
+        rows = [self.make_row() for _ in range(3)]
+        rows[1][2] = 'not-an-email'
+        rows[2][2] = self.user.email
+        response = self.client.post(self.url, {'file': self.make_csv(rows)})
+        assert response.json()['Status'] is False
+        assert set(response.json()['Errors']) == {'3', '4'}
+        assert User.objects.count() == 1
+
+    def test_onboarding_not_staff(self):
+        '''Тест регистрации из CSV не сотрудником сервиса'''
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.post(self.url, {'file': self.make_csv([self.make_row()])})
+        assert response.status_code == 403
+
+    def test_onboarding_command(self):
+        '''Тест команды регистрации пользователей из CSV'''
+        rows = [self.make_row() for _ in range(3)]
+        with NamedTemporaryFile('wb', suffix='.csv') as file:
+            file.write(self.make_csv(rows).read())
+            file.flush()
+            call_command('onboard_users', file.name, '--workers', '2', stdout=StringIO())
+        assert User.objects.filter(email__in=[row[2] for row in rows]).count() == 3
+
+    def test_confirmation_emails(self):
+        '''Тест отправки писем подтверждения одной задачей'''
+        users = UserFactory.create_batch(3)
+        new_users_registered_task(user_ids=[user.id for user in users])
+        assert len(mail.outbox) == 3
+        assert ConfirmEmailToken.objects.filter(user__in=users).count() == 3
+
+
 class ConfirmAccountTests(APITestCase):
     '''Класс тестирования подтверждения аккаунта по электронной почте'''
 
@@ -276,6 +411,35 @@ class ConfirmAccountTests(APITestCase):
         assert ConfirmEmailToken.objects.filter(user_id=user.id).first() is not None
         assert User.objects.filter(id=user.id).first().is_active == False
 
+    def test_confirm_token_expired(self):
+        '''Тест подтверждения почты истекшим токеном'''
+        user = UserFactory.create()
+        token, _ = ConfirmEmailToken.objects.get_or_create(user_id=user.id)
+        ConfirmEmailToken.objects.filter(id=token.id).update(created_at=datetime.now(timezone.utc) - timedelta(days=30))
+        data = {'email': user.email,
+                'token': token.key}
+        response = self.client.post(self.url, data)
+        assert response.json()['Status'] is False
+        assert User.objects.filter(id=user.id).first().is_active == False
+        delete_expired_confirm_email_tokens_task()
+        assert not User.objects.filter(id=user.id).exists()
+        assert not ConfirmEmailToken.objects.filter(user_id=user.id).exists()
+
+    def test_delete_expired_confirm_email_tokens(self):
+        '''Тест удаления истекших токенов и неподтвержденных пользователей'''
+        expired_users = UserFactory.create_batch(3)
+        active_user = UserFactory.create(is_active=True)
+        fresh_user = UserFactory.create()
+        for user in expired_users + [active_user, fresh_user]:
+            ConfirmEmailToken.objects.create(user=user)
+        ConfirmEmailToken.objects.exclude(user=fresh_user).update(
+            created_at=datetime.now(timezone.utc) - timedelta(days=30))
+        with self.settings(CONFIRM_EMAIL_TOKEN_CLEANUP_BATCH_SIZE=2):
+            delete_expired_confirm_email_tokens_task()
+        assert not User.objects.filter(id__in=[user.id for user in expired_users]).exists()
+        assert User.objects.filter(id=active_user.id).exists()
+        assert list(ConfirmEmailToken.objects.values_list('user_id', flat=True)) == [fresh_user.id]
+
 
 class AccountDetailsTests(APITestCase):
     '''Класс тестирования работы с данными пользователя'''
@@ -394,6 +558,171 @@ class LoginAccountTests(APITestCase):
         assert Token.objects.filter(user=user.id).first() is None
 
 
+class PasswordHashingTests(APITestCase):
+    '''Класс тестирования хеширования паролей в пуле потоков'''
+
+    url = reverse('backend:user-login')
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.user.set_password('Password-123')
+        self.user.is_active = True
+        self.user.save()
+
+    def test_login_rehashes_password(self):
+        '''Тест перехеширования пароля при изменении числа итераций'''
+        with self.settings(PASSWORD_HASHER_ITERATIONS=1000):
+            response = self.client.post(self.url, {'email': self.user.email, 'password': 'Password-123'})
+        assert response.json()['Status'] is True
+        self.user.refresh_from_db()
+        assert self.user.password.startswith('pbkdf2_sha256$1000$')
+        assert self.user.check_password('Password-123')
+
+    def test_edit_password(self):
+        '''Тест изменения пароля пользователя'''
+        log_in_user(self.user, self.client)
+        response = self.client.post(reverse('backend:user-details'), {'password': 'New-Password-456'})
+        assert response.json()['Status'] is True
+        self.user.refresh_from_db()
+        assert self.user.check_password('New-Password-456')
+
+    def test_pool_busy(self):
+        '''Тест ответа при превышении времени ожидания пула хеширования'''
+        with self.settings(PASSWORD_HASHING_TIMEOUT=0):
+            response = self.client.post(self.url, {'email': self.user.email, 'password': 'Password-123'})
+        assert response.status_code == 503
+
+
+class CachedTokenAuthenticationTests(APITestCase):
+    '''Класс тестирования авторизации по токену с кэшированием'''
+
+    url = reverse('backend:user-details')
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        log_in_user(self.user, self.client)
+
+    def test_authenticated_without_token_query(self):
+        '''Тест повторной авторизации без запроса токена к базе данных'''
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert response.data['email'] == self.user.email
+        assert not [query for query in queries if 'authtoken_token' in query['sql']]
+
+    def test_deleted_token(self):
+        '''Тест авторизации по удаленному токену'''
+        self.client.get(self.url)
+        Token.objects.filter(user=self.user).delete()
+        response = self.client.get(self.url)
+        assert response.status_code == 401
+
+    def test_deactivated_user(self):
+        '''Тест авторизации деактивированного пользователя'''
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(self.url)
+        assert response.status_code == 401
+
+    def test_expired_token(self):
+        '''Тест авторизации по истекшему токену'''
+        Token.objects.filter(user=self.user).update(created=datetime.now(timezone.utc) - timedelta(days=30))
+        response = self.client.get(self.url)
+        assert response.status_code == 401
+
+    def test_cached_fields(self):
+        '''Тест кэширования только полей для проверки доступа, без пароля'''
+        self.client.get(self.url)
+        key = Token.objects.get(user=self.user).key
+        payload = json.loads(get_redis().get(get_cache_key(key)))
+        assert payload['user'] == {'id': self.user.id, 'email': self.user.email, 'type': self.user.type,
+                                   'is_active': True, 'is_staff': False, 'is_superuser': False}
+
+    def test_user_saved(self):
+        '''Тест сброса кэша только при изменении кэшируемых полей пользователя'''
+        self.client.get(self.url)
+        cache_key = get_cache_key(Token.objects.get(user=self.user).key)
+        user = User.objects.get(id=self.user.id)
+        user.first_name = 'Name'
+        user.save()
+        assert get_redis().exists(cache_key)
+        user.is_staff = True
+        user.save()
+        assert not get_redis().exists(cache_key)
+
+    def test_user_deferred_fields(self):
+        '''Тест загрузки пользователя с отложенными полями и сброса кэша при их изменении'''
+        self.client.get(self.url)
+        cache_key = get_cache_key(Token.objects.get(user=self.user).key)
+        user = User.objects.only('id').get(id=self.user.id)
+        assert user.email == self.user.email
+        user.refresh_from_db(fields=['is_active'])
+        user.first_name = 'Name'
+        user.save(update_fields=['first_name'])
+        assert get_redis().exists(cache_key)
+        user = User.objects.defer('is_staff').get(id=self.user.id)
+        user.is_staff = True
+        user.save()
+        assert not get_redis().exists(cache_key)
+
+
+class TokenTests(APITestCase):
+    '''Класс тестирования выдачи и обновления токенов авторизации'''
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.user.set_password('Password-123')
+        log_in_user(self.user, self.client)
+        self.token = Token.objects.get(user=self.user)
+
+    def expire_token(self):
+        Token.objects.filter(user=self.user).update(created=datetime.now(timezone.utc) - timedelta(days=30))
+
+    def test_login_replaces_expired_token(self):
+        '''Тест выдачи нового токена при входе с истекшим токеном'''
+        self.expire_token()
+        data = {'email': self.user.email, 'password': 'Password-123'}
+        response = self.client.post(reverse('backend:user-login'), data)
+        assert response.json()['Status'] is True
+        assert response.json()['Token'] != self.token.key
+        assert Token.objects.get(user=self.user).key == response.json()['Token']
+
+    def test_login_keeps_valid_token(self):
+        '''Тест повторного входа с действующим токеном'''
+        data = {'email': self.user.email, 'password': 'Password-123'}
+        response = self.client.post(reverse('backend:user-login'), data)
+        assert response.json()['Token'] == self.token.key
+
+    def test_refresh_token(self):
+        '''Тест замены токена'''
+        response = self.client.post(reverse('backend:user-token-refresh'))
+        key = response.json()['Token']
+        assert key != self.token.key
+        assert not Token.objects.filter(key=self.token.key).exists()
+        assert self.client.get(reverse('backend:user-details')).status_code == 401
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + key)
+        assert self.client.get(reverse('backend:user-details')).status_code == 200
+
+    def test_delete_expired_tokens(self):
+        '''Тест удаления истекших токенов'''
+        users = UserFactory.create_batch(3)
+        for user in users:
+            Token.objects.create(user=user)
+        self.expire_token()
+        with self.settings(AUTH_TOKEN_CLEANUP_BATCH_SIZE=1):
+            delete_expired_tokens_task()
+        assert not Token.objects.filter(user=self.user).exists()
+        assert Token.objects.count() == 3
+
+    def test_token_created_index(self):
+        '''Тест индекса по времени создания токена для удаления истекших токенов'''
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Token._meta.db_table)
+        assert constraints['authtoken_token_created_idx']['columns'] == ['created']
+
+
 class CategoryTests(APITestCase):
     '''Класс тестирования просмотра категорий'''
 
@@ -586,6 +915,170 @@ class ContactTests(APITestCase):
         assert response.status_code == 403
 
 
+class PartnerOrdersTests(APITestCase):
+    '''Класс тестирования работы поставщиков с заказами'''
+
+    url = reverse('backend:partner-orders')
+
+    def log_in_shop(self):
+        '''Авторизация от лица поставщика'''
+        shop = ShopFactory.create(user__type='shop')
+        log_in_user(shop.user, self.client)
+        return shop
+
+    def test_order_item_shop_filled(self):
+        '''Тест заполнения магазина в позициях, созданных без него'''
+        item = OrderItemFactory.create(shop=None)
+        assert item.shop_id == item.product_info.shop_id
+        product_info = ProductInfoFactory.create()
+        OrderItem.objects.bulk_create([OrderItem(order=item.order, product_info=product_info, quantity=1)])
+        assert OrderItem.objects.get(product_info=product_info).shop_id == product_info.shop_id
+
+    def test_backfill_order_item_shops(self):
+        '''Тест заполнения магазина в существующих позициях командой backfill_order_item_shops'''
+        items = OrderItemFactory.create_batch(3)
+        OrderItem.objects.update(shop=None)
+        out = StringIO()
+        call_command('backfill_order_item_shops', batch_size=2, stdout=out)
+        assert 'Updated 3 order items' in out.getvalue()
+        for item in items:
+            assert OrderItem.objects.get(id=item.id).shop_id == item.product_info.shop_id
+
+    def test_backfill_order_item_prices(self):
+        '''Тест заполнения цен позиций и сумм заказов командой backfill_order_item_prices'''
+        order = OrderFactory.create(state='new')
+        items = OrderItemFactory.create_batch(3, order=order, product_info__price=100)
+        priced_item = OrderItemFactory.create(order__state='new', price=50)
+        OrderItem.objects.filter(order=order).update(price=0)
+        Order.objects.update(total_sum=0)
+        out = StringIO()
+        call_command('backfill_order_item_prices', batch_size=2, stdout=out)
+        assert 'Updated 3 order items' in out.getvalue()
+        assert OrderItem.objects.filter(order=order, price=100).count() == 3
+        assert Order.objects.get(id=order.id).total_sum == 100 * sum(item.quantity for item in items)
+        assert OrderItem.objects.get(id=priced_item.id).price == 50
+
+    def test_get_partner_orders_unauthenticated(self):
+        '''Тест просмотра заказов поставщика без авторизации'''
+        response = self.client.get(self.url)
+        assert response.status_code == 403
+
+    def test_get_partner_orders_not_shop(self):
+        '''Тест просмотра заказов поставщика от лица покупателя'''
+        log_in_user(UserFactory.create(), self.client)
+        response = self.client.get(self.url)
+        assert response.status_code == 403
+
+    def test_get_partner_orders_only_own_items(self):
+        '''Тест просмотра поставщиком только своих позиций в заказе'''
+        shop = self.log_in_shop()
+        order = OrderFactory.create()
+        own_item = OrderItemFactory.create(order=order, product_info__shop=shop, quantity=2)
+        OrderItemFactory.create(order=order)
+        OrderItemFactory.create()
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert len(response.data['results']) == 1
+        assert response.data['results'][0]['id'] == order.id
+        assert [item['id'] for item in response.data['results'][0]['ordered_items']] == [own_item.id]
+        assert response.data['results'][0]['shop_sum'] == 2 * own_item.price
+
+    def test_get_partner_orders_paginated(self):
+        '''Тест постраничного просмотра заказов поставщика'''
+        shop = self.log_in_shop()
+        for order in OrderFactory.create_batch(25):
+            OrderItemFactory.create_batch(2, order=order, product_info__shop=shop)
+        OrderItemFactory.create(order__state='basket', product_info__shop=shop)
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert len(response.data['results']) == 20
+        response = self.client.get(response.data['next'])
+        assert len(response.data['results']) == 5
+
+    def test_get_partner_orders_by_state(self):
+        '''Тест просмотра заказов поставщика по статусу'''
+        shop = self.log_in_shop()
+        OrderItemFactory.create(order__state='new', product_info__shop=shop)
+        item = OrderItemFactory.create(order__state='confirmed', product_info__shop=shop)
+        response = self.client.get(self.url, {'state': 'confirmed'})
+        assert response.status_code == 200
+        assert [order['id'] for order in response.data['results']] == [item.order.id]
+
+
+class PartnerOrdersStateTests(APITestCase):
+    '''Класс тестирования изменения поставщиком статусов заказов'''
+
+    url = reverse('backend:partner-orders-state')
+
+    def setUp(self):
+        self.shop = ShopFactory.create(user__type='shop')
+        log_in_user(self.shop.user, self.client)
+
+    def test_change_orders_state_unauthenticated(self):
+        '''Тест изменения статусов заказов без авторизации'''
+        self.client.credentials()
+        response = self.client.post(self.url, {'items': '1', 'state': 'confirmed'})
+        assert response.status_code == 403
+
+    def test_change_orders_state_correct(self):
+        '''Тест успешного изменения статусов нескольких заказов'''
+        items = OrderItemFactory.create_batch(3, order__state='new', product_info__shop=self.shop)
+        order_ids = ','.join(str(item.order.id) for item in items)
+        response = self.client.post(self.url, {'items': order_ids, 'state': 'confirmed'})
+        assert response.status_code == 200
+        assert response.json()['Status'] is True
+        assert Order.objects.filter(state='confirmed').count() == 3
+        assert EmailOutbox.objects.filter(kind='order_state_changed', state='confirmed').count() == 3
+
+    def test_change_orders_state_wrong_transition(self):
+        '''Тест изменения статуса заказа на недопустимый'''
+        item = OrderItemFactory.create(order__state='new', product_info__shop=self.shop)
+        response = self.client.post(self.url, {'items': str(item.order.id), 'state': 'sent'})
+        assert response.status_code == 200
+        assert Order.objects.get(id=item.order.id).state == 'new'
+        response = self.client.post(self.url, {'items': str(item.order.id), 'state': 'assembled',
+                                               'expected': 'new'})
+        assert response.json()['Status'] is False
+        assert Order.objects.get(id=item.order.id).state == 'new'
+
+    def test_change_orders_state_expected(self):
+        '''Тест изменения статусов только у заказов в ожидаемом статусе'''
+        new_item = OrderItemFactory.create(order__state='new', product_info__shop=self.shop)
+        confirmed_item = OrderItemFactory.create(order__state='confirmed', product_info__shop=self.shop)
+        order_ids = f'{new_item.order.id},{confirmed_item.order.id}'
+        response = self.client.post(self.url, {'items': order_ids, 'state': 'canceled', 'expected': 'confirmed'})
+        assert response.status_code == 200
+        assert Order.objects.get(id=new_item.order.id).state == 'new'
+        assert Order.objects.get(id=confirmed_item.order.id).state == 'canceled'
+
+    def test_change_orders_state_other_shop(self):
+        '''Тест изменения статуса заказа другого поставщика'''
+        item = OrderItemFactory.create(order__state='new')
+        response = self.client.post(self.url, {'items': str(item.order.id), 'state': 'confirmed'})
+        assert response.status_code == 200
+        assert Order.objects.get(id=item.order.id).state == 'new'
+
+    def test_change_orders_state_mixed_shops(self):
+        '''Тест изменения статуса заказа с позициями нескольких магазинов'''
+        item = OrderItemFactory.create(order__state='new', product_info__shop=self.shop,
+                                       product_info__quantity=5, quantity=3)
+        other_item = OrderItemFactory.create(order=item.order, product_info__quantity=5, quantity=2)
+        response = self.client.post(self.url, {'items': str(item.order.id), 'state': 'canceled'})
+        assert response.json()['Update'] == '0 orders'
+        assert Order.objects.get(id=item.order.id).state == 'new'
+        assert ProductInfo.objects.get(id=item.product_info.id).quantity == 5
+        assert ProductInfo.objects.get(id=other_item.product_info.id).quantity == 5
+
+    def test_cancel_orders_release_stock(self):
+        '''Тест возврата товаров на склад при отмене заказа'''
+        item = OrderItemFactory.create(order__state='new', product_info__shop=self.shop,
+                                       product_info__quantity=5, quantity=3)
+        response = self.client.post(self.url, {'items': str(item.order.id), 'state': 'canceled'})
+        assert response.status_code == 200
+        assert Order.objects.get(id=item.order.id).state == 'canceled'
+        assert ProductInfo.objects.get(id=item.product_info.id).quantity == 8
+
+
 class OrderTests(APITestCase):
     '''Класс тестирования работы с заказами покупателей'''
     url = reverse('backend:orders')
@@ -602,7 +1095,52 @@ class OrderTests(APITestCase):
         log_in_user(user, self.client)
         response = self.client.get(self.url)
         assert response.status_code == 200
-        assert response.data[0]['contact']['id'] == order.contact.id
+        assert response.data['results'][0]['contact']['id'] == order.contact.id
+
+    def test_get_user_orders_paginated(self):
+        '''Тест постраничного просмотра заказов покупателя'''
+        user = UserFactory.create()
+        OrderFactory.create_batch(25, user=user)
+        log_in_user(user, self.client)
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert len(response.data['results']) == 20
+        response = self.client.get(response.data['next'])
+        assert len(response.data['results']) == 5
+        assert response.data['next'] is None
+
+    def test_get_user_orders_by_state(self):
+        '''Тест просмотра заказов покупателя по статусу'''
+        user = UserFactory.create()
+        OrderFactory.create_batch(3, user=user, state='new')
+        sent_order = OrderFactory.create(user=user, state='sent')
+        log_in_user(user, self.client)
+        response = self.client.get(self.url, {'state': 'sent'})
+        assert response.status_code == 200
+        assert [order['id'] for order in response.data['results']] == [sent_order.id]
+
+    def test_get_user_orders_by_date(self):
+        '''Тест просмотра заказов покупателя за период'''
+        user = UserFactory.create()
+        orders = OrderFactory.create_batch(3, user=user)
+        for day, order in enumerate(orders, start=1):
+            Order.objects.filter(id=order.id).update(dt=datetime(2022, 10, day, 12, tzinfo=timezone.utc))
+        log_in_user(user, self.client)
+        response = self.client.get(self.url, {'dt_from': '2022-10-02', 'dt_to': '2022-10-02'})
+        assert response.status_code == 200
+        assert [order['id'] for order in response.data['results']] == [orders[1].id]
+        response = self.client.get(self.url, {'dt_from': '2022-10-02T13:00:00'})
+        assert [order['id'] for order in response.data['results']] == [orders[2].id]
+
+    def test_get_user_orders_wrong_filter(self):
+        '''Тест просмотра заказов покупателя с неверными фильтрами'''
+        user = UserFactory.create()
+        log_in_user(user, self.client)
+        response = self.client.get(self.url, {'dt_from': generate_random_string(10)})
+        assert response.status_code == 200
+        assert response.json()['Status'] is False
+        response = self.client.get(self.url, {'state': 'basket'})
+        assert response.json()['Status'] is False
 
     def test_make_new_order_unauthenticated(self):
         '''Тест создания нового заказа покупателя без авторизации'''
@@ -636,6 +1174,121 @@ class OrderTests(APITestCase):
         assert response.status_code == 200
         assert Order.objects.get(id=basket.id).state == 'basket'
 
+    def test_make_new_order_reserves_stock(self):
+        '''Тест резервирования товаров на складе при создании заказа покупателя'''
+        item = OrderItemFactory.create(order__state='basket', product_info__quantity=10, quantity=4)
+        user = item.order.user
+        log_in_user(user, self.client)
+        response = self.client.post(self.url, {'id': item.order.id,
+                                               'contact': item.order.contact.id})
+        assert response.status_code == 200
+        assert Order.objects.get(id=item.order.id).state == 'new'
+        assert ProductInfo.objects.get(id=item.product_info.id).quantity == 6
+
+    def test_make_new_order_not_enough_stock(self):
+        '''Тест создания заказа покупателя с недостаточным количеством товара на складе'''
+        basket = OrderFactory.create(state='basket')
+        available_item = OrderItemFactory.create(order=basket, product_info__quantity=10, quantity=4)
+        unavailable_item = OrderItemFactory.create(order=basket, product_info__quantity=1, quantity=2)
+        log_in_user(basket.user, self.client)
+        response = self.client.post(self.url, {'id': basket.id,
+                                               'contact': basket.contact.id})
+        assert response.status_code == 200
+        assert response.json()['Items'] == [unavailable_item.product_info.id]
+        assert Order.objects.get(id=basket.id).state == 'basket'
+        assert ProductInfo.objects.get(id=available_item.product_info.id).quantity == 10
+        assert ProductInfo.objects.get(id=unavailable_item.product_info.id).quantity == 1
+
+    def test_make_new_order_fixes_prices(self):
+        '''Тест сохранения цен товаров в заказе покупателя'''
+        item = OrderItemFactory.create(order__state='basket', product_info__quantity=10, quantity=2)
+        ProductInfo.objects.filter(id=item.product_info.id).update(price=100)
+        log_in_user(item.order.user, self.client)
+        self.client.post(self.url, {'id': item.order.id,
+                                    'contact': item.order.contact.id})
+        ProductInfo.objects.filter(id=item.product_info.id).update(price=300)
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert response.data['results'][0]['total_sum'] == 200
+        assert response.data['results'][0]['sub_orders'][0]['ordered_items'][0]['price'] == 100
+
+    def test_make_new_order_split_by_shops(self):
+        '''Тест разделения заказа покупателя на заказы по магазинам'''
+        basket = OrderFactory.create(state='basket')
+        first_shop_items = OrderItemFactory.create_batch(2, order=basket, product_info__quantity=10)
+        second_shop_item = OrderItemFactory.create(order=basket, product_info__quantity=10)
+        ProductInfo.objects.filter(id=first_shop_items[1].product_info.id).update(shop=first_shop_items[0].shop)
+        OrderItem.objects.filter(id=first_shop_items[1].id).update(shop=first_shop_items[0].shop)
+        log_in_user(basket.user, self.client)
+        response = self.client.post(self.url, {'id': basket.id,
+                                               'contact': basket.contact.id})
+        assert response.status_code == 200
+        sub_orders = Order.objects.filter(parent_id=basket.id).order_by('id')
+        assert [sub_order.shop_id for sub_order in sub_orders] == sorted(
+            [first_shop_items[0].shop.id, second_shop_item.shop.id])
+        for sub_order in sub_orders:
+            assert sub_order.state == 'new'
+            assert sub_order.total_sum == sum(item.quantity * item.price for item in sub_order.ordered_items.all())
+        assert OrderItem.objects.filter(order_id=basket.id).count() == 0
+        response = self.client.get(self.url)
+        assert [order['id'] for order in response.data['results']] == [basket.id]
+        assert len(response.data['results'][0]['sub_orders']) == 2
+
+    def test_get_user_orders_by_sub_orders_state(self):
+        '''Тест статуса основного заказа после изменения поставщиками статусов заказов по магазинам'''
+        basket = OrderFactory.create(state='basket')
+        items = OrderItemFactory.create_batch(2, order=basket, product_info__quantity=10,
+                                              product_info__shop__user__type='shop')
+        log_in_user(basket.user, self.client)
+        self.client.post(self.url, {'id': basket.id, 'contact': basket.contact.id})
+        partner_client = APIClient()
+        for item in items:
+            sub_order = Order.objects.get(parent_id=basket.id, shop=item.shop)
+            log_in_user(item.shop.user, partner_client)
+            response = partner_client.post(reverse('backend:partner-orders-state'),
+                                           {'items': str(sub_order.id), 'state': 'confirmed'})
+            assert response.json()['Update'] == '1 orders'
+            expected = 'confirmed' if item == items[-1] else 'new'
+            response = self.client.get(self.url, {'state': expected})
+            assert [order['id'] for order in response.data['results']] == [basket.id]
+            assert response.data['results'][0]['state'] == expected
+        log_in_user(items[0].shop.user, partner_client)
+        partner_client.post(reverse('backend:partner-orders-state'),
+                            {'items': str(Order.objects.get(parent_id=basket.id, shop=items[0].shop).id),
+                             'state': 'canceled'})
+        assert Order.objects.get(id=basket.id).state == 'confirmed'
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class OrderConcurrencyTests(TransactionTestCase):
+    '''Класс тестирования резервирования товаров при одновременном создании заказов'''
+
+    url = reverse('backend:orders')
+
+    def test_make_new_orders_concurrently(self):
+        '''Тест отсутствия перепродажи товара при одновременном создании заказов'''
+        stock = 50
+        product_info = ProductInfoFactory.create(quantity=stock)
+        baskets = []
+        for i in range(200):
+            basket = OrderFactory.create(state='basket')
+            OrderItemFactory.create(order=basket, product_info=product_info, quantity=1)
+            baskets.append(basket)
+
+        def make_order(basket):
+            client = APIClient()
+            log_in_user(basket.user, client)
+            try:
+                return client.post(self.url, {'id': basket.id, 'contact': basket.contact.id}).json()['Status']
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            results = list(executor.map(make_order, baskets))
+        assert results.count(True) == stock
+        assert ProductInfo.objects.get(id=product_info.id).quantity == 0
+        assert Order.objects.filter(id__in=[basket.id for basket in baskets], state='new').count() == stock
+
 
 class BasketTest(APITestCase):
     '''Класс тестирования работы с корзиной покупателя'''
@@ -662,3 +1315,882 @@ class BasketTest(APITestCase):
         '''Тест удаления корзины покупателя без авторизации'''
         response = self.client.delete(self.url)
         assert response.status_code == 403
+
+    def test_edit_user_basket_quantities_correct(self):
+        '''Тест успешного изменения количества товаров в корзине покупателя'''
+        basket = OrderFactory.create(state='basket')
+        items = OrderItemFactory.create_batch(3, order=basket)
+        foreign_item = OrderItemFactory.create()
+        log_in_user(basket.user, self.client)
+        data = [{'id': item.id, 'quantity': item.quantity + 5} for item in items]
+        data.append({'id': foreign_item.id, 'quantity': 100})
+        response = self.client.put(self.url, {'items': json.dumps(data)})
+        assert response.status_code == 200
+        for item in items:
+            assert OrderItem.objects.get(id=item.id).quantity == item.quantity + 5
+        assert OrderItem.objects.get(id=foreign_item.id).quantity == foreign_item.quantity
+
+    def test_edit_user_basket_quantities_single_query(self):
+        '''Тест изменения количества товаров в корзине покупателя за один запрос'''
+        basket = OrderFactory.create(state='basket')
+        items = OrderItemFactory.create_batch(10, order=basket)
+        log_in_user(basket.user, self.client)
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as one_item:
+            self.client.put(self.url, {'items': json.dumps([{'id': items[0].id, 'quantity': 1}])})
+        with CaptureQueriesContext(connection) as many_items:
+            self.client.put(self.url, {'items': json.dumps([{'id': item.id, 'quantity': 2} for item in items])})
+        assert len(one_item) == len(many_items)
+        assert OrderItem.objects.filter(order_id=basket.id, quantity=2).count() == len(items)
+
+    def test_edit_user_basket_quantities_wrong_format(self):
+        '''Тест изменения количества товаров в корзине покупателя с неверным форматом'''
+        user = UserFactory.create()
+        log_in_user(user, self.client)
+        for items in ([1], {'a': 1}, 'items'):
+            response = self.client.put(self.url, {'items': json.dumps(items)})
+            assert response.status_code == 200
+            assert response.json() == {'Status': False, 'Error': 'Wrong format'}
+
+    def test_add_user_basket_items_correct(self):
+        '''Тест успешного добавления товаров в корзину покупателя'''
+        user = UserFactory.create()
+        product_infos = ProductInfoFactory.create_batch(2)
+        log_in_user(user, self.client)
+        data = [{'product_info': product_info.id, 'quantity': 3} for product_info in product_infos]
+        response = self.client.post(self.url, {'items': json.dumps(data)})
+        assert response.status_code == 200
+        assert response.json()['Status'] is True
+        assert OrderItem.objects.filter(order__user_id=user.id, order__state='basket', quantity=3).count() == 2
+
+    def test_add_user_basket_existing_item_increment(self):
+        '''Тест повторного добавления товара в корзину покупателя'''
+        item = OrderItemFactory.create(order__state='basket', quantity=2)
+        log_in_user(item.order.user, self.client)
+        data = [{'product_info': item.product_info.id, 'quantity': 3}]
+        response = self.client.post(self.url, {'items': json.dumps(data)})
+        assert response.status_code == 200
+        assert response.json()['Status'] is True
+        assert OrderItem.objects.get(id=item.id).quantity == 5
+        assert OrderItem.objects.filter(order_id=item.order.id).count() == 1
+
+    def test_add_user_basket_existing_item_set(self):
+        '''Тест замены количества товара при повторном добавлении в корзину покупателя'''
+        item = OrderItemFactory.create(order__state='basket', quantity=2)
+        log_in_user(item.order.user, self.client)
+        data = [{'product_info': item.product_info.id, 'quantity': 7}]
+        response = self.client.post(self.url, {'items': json.dumps(data), 'mode': 'set'})
+        assert response.status_code == 200
+        assert OrderItem.objects.get(id=item.id).quantity == 7
+
+    def test_add_user_basket_item_not_exist(self):
+        '''Тест добавления несуществующего товара в корзину покупателя'''
+        user = UserFactory.create()
+        log_in_user(user, self.client)
+        data = [{'product_info': random.randint(1, 20), 'quantity': 1}]
+        response = self.client.post(self.url, {'items': json.dumps(data)})
+        assert response.status_code == 200
+        assert response.json()['Status'] is False
+        assert OrderItem.objects.count() == 0
+
+    def test_user_basket_total_sum(self):
+        '''Тест пересчета суммы корзины покупателя при изменении товаров'''
+        user = UserFactory.create()
+        product_infos = ProductInfoFactory.create_batch(2)
+        log_in_user(user, self.client)
+        data = [{'product_info': product_info.id, 'quantity': 2} for product_info in product_infos]
+        self.client.post(self.url, {'items': json.dumps(data)})
+        basket = Order.objects.get(user_id=user.id, state='basket')
+        assert basket.total_sum == 2 * sum(product_info.price for product_info in product_infos)
+        item = basket.ordered_items.get(product_info_id=product_infos[0].id)
+        self.client.delete(self.url, {'items': str(item.id)})
+        response = self.client.get(self.url)
+        assert response.data[0]['total_sum'] == 2 * product_infos[1].price
+
+
+class BasketSummaryTests(APITestCase):
+    '''Класс тестирования краткой информации о корзине покупателя'''
+
+    url = reverse('backend:basket-summary')
+
+    def test_get_basket_summary_unauthenticated(self):
+        '''Тест просмотра краткой информации о корзине без авторизации'''
+        response = self.client.get(self.url)
+        assert response.status_code == 403
+
+    def test_get_basket_summary_correct(self):
+        '''Тест успешного просмотра краткой информации о корзине'''
+        basket = OrderFactory.create(state='basket')
+        items = OrderItemFactory.create_batch(3, order=basket)
+        OrderItemFactory.create(order__user=basket.user)
+        log_in_user(basket.user, self.client)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert response.data == {
+            'lines_count': 3,
+            'units_count': sum(item.quantity for item in items),
+            'total_sum': sum(item.quantity * item.price for item in items),
+        }
+        assert len([query for query in queries if 'backend_orderitem' in query['sql']]) == 1
+
+    def test_get_empty_basket_summary(self):
+        '''Тест просмотра краткой информации о пустой корзине'''
+        log_in_user(UserFactory.create(), self.client)
+        response = self.client.get(self.url)
+        assert response.data == {'lines_count': 0, 'units_count': 0, 'total_sum': 0}
+
+
+class AsyncViewsTests(APITestCase):
+    '''Класс тестирования асинхронных представлений для чтения'''
+
+    def test_get_products(self):
+        '''Тест постраничного асинхронного поиска товаров'''
+        product_infos = ProductInfoFactory.create_batch(25)
+        response = self.client.get(reverse('backend:async-products'))
+        assert response.status_code == 200
+        assert response.json()['count'] == 25
+        assert [item['id'] for item in response.json()['results']] == [item.id for item in product_infos[:20]]
+        response = self.client.get(response.json()['next'])
+        assert len(response.json()['results']) == 5
+        assert response.json()['next'] is None
+        response = self.client.get(reverse('backend:async-products'), {'shop_id': product_infos[0].shop_id})
+        assert [item['id'] for item in response.json()['results']] == [product_infos[0].id]
+        response = self.client.get(reverse('backend:async-products'), {'page': 2})
+        sync_response = self.client.get(reverse('backend:products-search'), {'page': 2})
+        assert response.json()['count'] == sync_response.json()['count']
+        assert response.json()['results'] == sync_response.json()['results']
+
+    def test_get_basket(self):
+        '''Тест асинхронного просмотра корзины'''
+        basket = OrderFactory.create(state='basket')
+        OrderItemFactory.create_batch(3, order=basket)
+        log_in_user(basket.user, self.client)
+        response = self.client.get(reverse('backend:async-basket'))
+        assert response.status_code == 200
+        assert response.json() == self.client.get(reverse('backend:basket')).json()
+
+    def test_get_orders(self):
+        '''Тест асинхронного просмотра заказов'''
+        user = UserFactory.create()
+        OrderFactory.create_batch(25, user=user)
+        OrderFactory.create(user=user, state='basket')
+        log_in_user(user, self.client)
+        response = self.client.get(reverse('backend:async-orders'))
+        assert response.status_code == 200
+        assert response.json()['results'] == self.client.get(reverse('backend:orders')).json()['results']
+        response = self.client.get(response.json()['next'])
+        assert len(response.json()['results']) == 5
+        response = self.client.get(reverse('backend:async-orders'), {'state': 'basket'})
+        assert response.json() == {'Status': False, 'Error': 'Wrong state'}
+
+    def test_unauthenticated(self):
+        '''Тест асинхронного просмотра корзины и заказов без авторизации'''
+        assert self.client.get(reverse('backend:async-basket')).status_code == 403
+        assert self.client.get(reverse('backend:async-orders')).status_code == 403
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + generate_random_string(40))
+        assert self.client.get(reverse('backend:async-orders')).status_code == 401
+
+    def test_throttling(self):
+        '''Тест ограничения частоты асинхронных запросов'''
+        class Throttle(AnonRateThrottle):
+            rate = '2/minute'
+            timer = staticmethod(lambda: 1_000_000_030.0)
+
+        redis = get_redis()
+        keys = redis.keys('throttle_*')
+        if keys:
+            redis.delete(*keys)
+        with patch.object(AsyncView, 'throttle_classes', [Throttle]):
+            responses = [self.client.get(reverse('backend:async-products')) for _ in range(3)]
+        assert [response.status_code for response in responses] == [200, 200, 429]
+        assert responses[-1]['Retry-After'] == '50'
+
+
+@override_settings(BASKET_STORAGE='redis')
+class RedisBasketTests(APITestCase):
+    '''Класс тестирования работы с корзиной покупателя в Redis'''
+
+    url = reverse('backend:basket')
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.redis_basket = RedisBasket(self.user.id)
+        self.redis_basket.clear()
+        log_in_user(self.user, self.client)
+
+    def tearDown(self):
+        self.redis_basket.clear()
+
+    def test_add_user_basket_items(self):
+        '''Тест добавления товаров в корзину покупателя в Redis'''
+        product_info = ProductInfoFactory.create()
+        data = [{'product_info': product_info.id, 'quantity': 2}]
+        self.client.post(self.url, {'items': json.dumps(data)})
+        response = self.client.post(self.url, {'items': json.dumps(data)})
+        assert response.status_code == 200
+        assert response.json()['Status'] is True
+        assert self.redis_basket.get_items() == {product_info.id: 4}
+        assert Order.objects.filter(user_id=self.user.id).count() == 0
+        response = self.client.get(self.url)
+        assert response.data[0]['ordered_items'][0]['product_info']['id'] == product_info.id
+        assert response.data[0]['total_sum'] == 4 * product_info.price
+
+    def test_edit_user_basket_items(self):
+        '''Тест изменения и удаления товаров в корзине покупателя в Redis'''
+        product_infos = ProductInfoFactory.create_batch(2)
+        self.redis_basket.add({product_info.id: 1 for product_info in product_infos})
+        data = [{'id': product_infos[0].id, 'quantity': 5}, {'id': random.randint(10000, 20000), 'quantity': 5}]
+        response = self.client.put(self.url, {'items': json.dumps(data)})
+        assert response.json()['Update'] == '1 items'
+        response = self.client.delete(self.url, {'items': str(product_infos[1].id)})
+        assert response.json()['Delete'] == '1 items'
+        assert self.redis_basket.get_items() == {product_infos[0].id: 5}
+
+    def test_get_user_basket_async(self):
+        '''Тест асинхронного просмотра корзины покупателя в Redis'''
+        product_info = ProductInfoFactory.create()
+        self.redis_basket.add({product_info.id: 2})
+        response = self.client.get(reverse('backend:async-basket'))
+        assert response.status_code == 200
+        assert response.json() == self.client.get(self.url).json()
+
+    def test_make_new_order_from_user_basket(self):
+        '''Тест создания заказа из корзины покупателя в Redis'''
+        product_info = ProductInfoFactory.create(quantity=10)
+        contact = ContactFactory.create(user=self.user)
+        self.redis_basket.add({product_info.id: 3})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('backend:orders'), {'contact': contact.id})
+        assert response.status_code == 200
+        assert response.json()['Status'] is True
+        order = Order.objects.get(user_id=self.user.id, parent__isnull=True)
+        assert order.state == 'new'
+        assert order.total_sum == 3 * product_info.price
+        assert order.sub_orders.get().ordered_items.get().quantity == 3
+        assert ProductInfo.objects.get(id=product_info.id).quantity == 7
+        assert self.redis_basket.get_items() == {}
+
+    def test_make_new_order_keeps_items_added_during_checkout(self):
+        '''Тест сохранения в корзине товаров, добавленных в Redis во время оформления заказа'''
+        product_infos = ProductInfoFactory.create_batch(3, quantity=10)
+        contact = ContactFactory.create(user=self.user)
+        self.redis_basket.add({product_infos[0].id: 3, product_infos[1].id: 1})
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('backend:orders'), {'contact': contact.id})
+        assert response.json()['Status'] is True
+        self.redis_basket.add({product_infos[1].id: 2, product_infos[2].id: 4})
+        for callback in callbacks:
+            callback()
+        assert self.redis_basket.get_items() == {product_infos[1].id: 2, product_infos[2].id: 4}
+
+    def test_make_new_order_from_user_basket_not_enough_stock(self):
+        '''Тест создания заказа из корзины покупателя в Redis с недостаточным количеством товара'''
+        product_info = ProductInfoFactory.create(quantity=1)
+        contact = ContactFactory.create(user=self.user)
+        self.redis_basket.add({product_info.id: 3})
+        response = self.client.post(reverse('backend:orders'), {'contact': contact.id})
+        assert response.json()['Items'] == [product_info.id]
+        assert Order.objects.filter(user_id=self.user.id).count() == 0
+        assert self.redis_basket.get_items() == {product_info.id: 3}
+
+    def test_get_basket_summary(self):
+        '''Тест просмотра краткой информации о корзине покупателя в Redis'''
+        product_infos = ProductInfoFactory.create_batch(2)
+        self.redis_basket.add({product_info.id: 2 for product_info in product_infos})
+        response = self.client.get(reverse('backend:basket-summary'))
+        assert response.data == {
+            'lines_count': 2,
+            'units_count': 4,
+            'total_sum': 2 * sum(product_info.price for product_info in product_infos),
+        }
+
+
+class IdempotencyTests(APITestCase):
+    '''Класс тестирования повторных запросов с заголовком Idempotency-Key'''
+
+    url = reverse('backend:basket')
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        log_in_user(self.user, self.client)
+
+    def test_repeat_add_user_basket_items(self):
+        '''Тест повторного добавления товаров в корзину с тем же ключом'''
+        product_info = ProductInfoFactory.create()
+        data = {'items': json.dumps([{'product_info': product_info.id, 'quantity': 2}])}
+        idempotency_key = str(uuid4())
+        first_response = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+        second_response = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+        assert second_response.status_code == 200
+        assert second_response.json() == first_response.json()
+        assert OrderItem.objects.get(order__user_id=self.user.id).quantity == 2
+        self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=str(uuid4()))
+        assert OrderItem.objects.get(order__user_id=self.user.id).quantity == 4
+
+    @override_settings(IDEMPOTENCY_LOCK_TTL=1)
+    def test_repeat_after_killed_request(self):
+        '''Тест повтора с тем же ключом после запроса, прерванного вместе с процессом'''
+        product_info = ProductInfoFactory.create()
+        data = {'items': json.dumps([{'product_info': product_info.id, 'quantity': 2}])}
+        idempotency_key = str(uuid4())
+        with patch.object(OrderItem.objects, 'upsert', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+        response = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+        assert response.status_code == 409
+        time.sleep(1.1)
+        response = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+        assert response.json()['Status'] is True
+        assert OrderItem.objects.get(order__user_id=self.user.id).quantity == 2
+
+    def test_repeat_with_other_arguments(self):
+        '''Тест повторного запроса с тем же ключом и другими аргументами'''
+        product_infos = ProductInfoFactory.create_batch(2)
+        idempotency_key = str(uuid4())
+        for product_info in product_infos:
+            data = {'items': json.dumps([{'product_info': product_info.id, 'quantity': 1}])}
+            response = self.client.post(self.url, data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+        assert response.status_code == 422
+        assert OrderItem.objects.filter(order__user_id=self.user.id).count() == 1
+
+    def test_fingerprint_list_body(self):
+        '''Тест отпечатка запроса с телом JSON, которое не является объектом'''
+        factory = APIRequestFactory()
+
+        def get_request_fingerprint(body):
+            request = Request(factory.post(self.url, body, format='json'), parsers=[JSONParser()])
+            return get_fingerprint(request)
+
+        assert get_request_fingerprint([1, 2]) == get_request_fingerprint([1, 2])
+        assert get_request_fingerprint([1, 2]) != get_request_fingerprint([2, 1])
+        assert get_request_fingerprint({'items': '1', 'mode': 'add'}) == \
+            get_request_fingerprint({'mode': 'add', 'items': '1'})
+
+    def test_repeat_make_new_order(self):
+        '''Тест повторного создания заказа с тем же ключом'''
+        item = OrderItemFactory.create(order__user=self.user, order__state='basket',
+                                       product_info__quantity=10, quantity=2)
+        data = {'id': item.order.id, 'contact': item.order.contact.id}
+        idempotency_key = str(uuid4())
+        for i in range(3):
+            response = self.client.post(reverse('backend:orders'), data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+            assert response.json()['Status'] is True
+        assert ProductInfo.objects.get(id=item.product_info.id).quantity == 8
+
+    @override_settings(BASKET_STORAGE='redis')
+    def test_repeat_make_new_order_after_locked_basket(self):
+        '''Тест повтора с тем же ключом после ответа о заблокированной корзине'''
+        redis_basket = RedisBasket(self.user.id)
+        redis_basket.clear()
+        self.addCleanup(redis_basket.clear)
+        product_info = ProductInfoFactory.create(quantity=10)
+        redis_basket.add({product_info.id: 2})
+        data = {'contact': ContactFactory.create(user=self.user).id}
+        idempotency_key = str(uuid4())
+        with patch.object(RedisBasket, 'lock', lambda basket: basket.redis.lock(
+                f'{basket.key}:checkout', timeout=60, blocking_timeout=0)):
+            with redis_basket.lock():
+                response = self.client.post(reverse('backend:orders'), data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+                assert response.status_code == 409
+            response = self.client.post(reverse('backend:orders'), data, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+        assert response.json()['Status'] is True
+        assert ProductInfo.objects.get(id=product_info.id).quantity == 8
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    '''Минимальный SMTP-сервер: принимает письма и запоминает их.
+
+    После server.messages_per_connection писем сервер закрывает соединение.
+
+    '''
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        self.wfile.write(b'220 localhost\r\n')
+        accepted = 0
+        while line := self.rfile.readline():
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.wfile.write(b'250 localhost\r\n')
+            elif command == b'DATA':
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                data = []
+                while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+                    data.append(line)
+                self.server.messages.append(b''.join(data))
+                self.wfile.write(b'250 OK\r\n')
+                accepted += 1
+                if accepted == self.server.messages_per_connection:
+                    return
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+class EmailTests(APITestCase):
+    '''Класс тестирования отправки писем через постоянное SMTP-соединение'''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.connections = []
+        self.server.messages = []
+        self.server.messages_per_connection = None
+        email_settings = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.server.server_address[1], EMAIL_HOST_USER=None, EMAIL_USE_TLS=False,
+            DEFAULT_FROM_EMAIL='shop@example.com')
+        email_settings.enable()
+        self.addCleanup(email_settings.disable)
+
+    def test_tasks_share_connection(self):
+        '''Тест отправки писем нескольких задач через одно соединение'''
+        orders = OrderFactory.create_batch(5)
+        EmailOutbox.objects.add('new_order', [order.id for order in orders[:2]])
+        EmailOutbox.objects.add('order_state_changed', [order.id for order in orders], state='sent')
+        send_outbox_emails_task()
+        new_users_registered_task(user_ids=[order.user.id for order in orders[:3]])
+        assert len(self.server.messages) == 10
+        assert len(self.server.connections) == 1
+
+    def test_reconnect(self):
+        '''Тест повторного подключения после закрытия соединения сервером'''
+        orders = OrderFactory.create_batch(3)
+        EmailOutbox.objects.add('new_order', [orders[0].id])
+        send_outbox_emails_task()
+        self.server.connections[0].shutdown(socket.SHUT_RDWR)
+        EmailOutbox.objects.add('order_state_changed', [order.id for order in orders], state='sent')
+        send_outbox_emails_task()
+        assert len(self.server.messages) == 4
+        assert len(self.server.connections) == 2
+        assert not EmailOutbox.objects.filter(sent_at__isnull=True).exists()
+
+    def test_reconnect_without_duplicates(self):
+        '''Тест продолжения отправки с первого неотправленного письма после закрытия соединения'''
+        self.server.messages_per_connection = 2
+        users = UserFactory.create_batch(5)
+        new_users_registered_task(user_ids=[user.id for user in users])
+        assert len(self.server.messages) == 5
+        assert len(self.server.connections) == 3
+
+
+class EmailOutboxTests(APITestCase):
+    '''Класс тестирования исходящих уведомлений о заказах'''
+
+    def test_make_new_order_outbox(self):
+        '''Тест записи и отправки уведомлений о новом заказе'''
+        basket = OrderFactory.create(state='basket')
+        OrderItemFactory.create_batch(2, order=basket, product_info__quantity=10, quantity=1)
+        log_in_user(basket.user, self.client)
+        response = self.client.post(reverse('backend:orders'), {'id': str(basket.id), 'contact': basket.contact.id})
+        assert response.json()['Status'] is True
+        assert sorted(EmailOutbox.objects.values_list('kind', flat=True)) == [
+            'new_order', 'new_sub_order', 'new_sub_order']
+        send_outbox_emails_task()
+        assert len(mail.outbox) == 1
+        EmailOutbox.objects.update(next_attempt_at=datetime.now(timezone.utc))
+        send_outbox_emails_task()
+        assert len(mail.outbox) == 3
+        assert not EmailOutbox.objects.filter(sent_at__isnull=True).exists()
+        send_outbox_emails_task()
+        assert len(mail.outbox) == 3
+
+    def test_partner_notifications_coalesced(self):
+        '''Тест объединения уведомлений поставщика о нескольких заказах в одно письмо'''
+        shop = ShopFactory.create(user=UserFactory.create(type='shop'))
+        sub_orders = []
+        for i in range(3):
+            basket = OrderFactory.create(state='basket')
+            OrderItemFactory.create(order=basket, product_info__shop=shop, product_info__quantity=10, quantity=1)
+            OrderItemFactory.create(order=basket, product_info__quantity=10, quantity=1)
+            log_in_user(basket.user, self.client)
+            self.client.post(reverse('backend:orders'), {'id': str(basket.id), 'contact': basket.contact.id})
+            sub_orders.append(basket.sub_orders.get(shop=shop))
+        EmailOutbox.objects.update(next_attempt_at=datetime.now(timezone.utc))
+        send_outbox_emails_task()
+        shop_messages = [message for message in mail.outbox if message.to == [shop.user.email]]
+        assert len(shop_messages) == 1
+        assert shop_messages[0].subject == 'Новые заказы: 3'
+        assert all(f'Заказ №{sub_order.id}' in shop_messages[0].body for sub_order in sub_orders)
+        assert len(mail.outbox) == 3 + 3 + 1
+
+    def test_partner_notifications_window(self):
+        '''Тест объединения уведомлений о заказах, оформленных в разное время в пределах окна'''
+        shop = ShopFactory.create(user=UserFactory.create(type='shop'))
+        sub_orders = []
+        for i in range(2):
+            basket = OrderFactory.create(state='basket')
+            OrderItemFactory.create(order=basket, product_info__shop=shop, product_info__quantity=10, quantity=1)
+            log_in_user(basket.user, self.client)
+            self.client.post(reverse('backend:orders'), {'id': str(basket.id), 'contact': basket.contact.id})
+            sub_orders.append(basket.sub_orders.get(shop=shop))
+        now = datetime.now(timezone.utc)
+        EmailOutbox.objects.filter(order=sub_orders[0]).update(next_attempt_at=now + timedelta(seconds=10))
+        EmailOutbox.objects.filter(order=sub_orders[1]).update(next_attempt_at=now + timedelta(seconds=20))
+        send_outbox_emails_task()
+        assert not [message for message in mail.outbox if message.to == [shop.user.email]]
+        EmailOutbox.objects.filter(order=sub_orders[0]).update(next_attempt_at=now)
+        send_outbox_emails_task()
+        shop_messages = [message for message in mail.outbox if message.to == [shop.user.email]]
+        assert len(shop_messages) == 1
+        assert shop_messages[0].subject == 'Новые заказы: 2'
+        assert not EmailOutbox.objects.filter(kind='new_sub_order', sent_at__isnull=True).exists()
+
+    def test_order_state_changed_outbox(self):
+        '''Тест записи уведомления об изменении статуса заказа поставщиком'''
+        item = OrderItemFactory.create(order__state='new')
+        item.shop.user = UserFactory.create(type='shop')
+        item.shop.save()
+        log_in_user(item.shop.user, self.client)
+        response = self.client.post(reverse('backend:partner-orders-state'),
+                                    {'items': str(item.order.id), 'state': 'confirmed'})
+        assert response.json()['Update'] == '1 orders'
+        assert EmailOutbox.objects.get().state == 'confirmed'
+        send_outbox_emails_task()
+        assert mail.outbox[0].to == [item.order.user.email]
+
+    def test_deduplication(self):
+        '''Тест повторного добавления уведомления'''
+        order = OrderFactory.create()
+        EmailOutbox.objects.add('new_order', [order.id])
+        EmailOutbox.objects.add('new_order', [order.id])
+        assert EmailOutbox.objects.count() == 1
+
+    def test_retry(self):
+        '''Тест повторной попытки отправки после ошибки'''
+        order = OrderFactory.create()
+        EmailOutbox.objects.add('new_order', [order.id])
+        with socket.socket() as closed_socket:
+            closed_socket.bind(('127.0.0.1', 0))
+            port = closed_socket.getsockname()[1]
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+                           EMAIL_PORT=port, EMAIL_HOST_USER=None, EMAIL_USE_TLS=False):
+            send_outbox_emails_task()
+            send_outbox_emails_task()
+        item = EmailOutbox.objects.get()
+        assert item.attempts == 1
+        assert item.sent_at is None and item.error
+        EmailOutbox.objects.update(next_attempt_at=datetime.now(timezone.utc))
+        send_outbox_emails_task()
+        assert EmailOutbox.objects.get().sent_at is not None
+        assert len(mail.outbox) == 1
+
+
+class OrderEventsPublishTests(APITestCase):
+    '''Класс тестирования публикации событий заказов'''
+
+    def setUp(self):
+        self.pubsub = get_redis().pubsub()
+
+    def tearDown(self):
+        self.pubsub.close()
+
+    def get_events(self):
+        events = []
+        while message := self.pubsub.get_message(timeout=0.5):
+            if message['type'] == 'message':
+                events.append((message['channel'], json.loads(message['data'])))
+        return events
+
+    def test_make_new_order_events(self):
+        '''Тест событий оформления заказа для покупателя и поставщика'''
+        basket = OrderFactory.create(state='basket')
+        item = OrderItemFactory.create(order=basket, product_info__quantity=10, quantity=1)
+        self.pubsub.subscribe(get_channel(basket.user.id), get_channel(item.shop.user.id))
+        log_in_user(basket.user, self.client)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('backend:orders'), {'id': str(basket.id), 'contact': basket.contact.id})
+        sub_order = basket.sub_orders.get()
+        events = self.get_events()
+        buyer_event = {'event': 'order_created', 'order_id': basket.id, 'state': 'new'}
+        assert (get_channel(basket.user.id), buyer_event) in events
+        assert (get_channel(item.shop.user.id), {'event': 'order_created', 'order_id': sub_order.id,
+                                                 'parent_id': basket.id, 'state': 'new'}) in events
+
+    def test_order_state_changed_events(self):
+        '''Тест событий изменения статуса заказа поставщиком'''
+        item = OrderItemFactory.create(order__state='new')
+        item.shop.user.type = 'shop'
+        item.shop.user.save()
+        self.pubsub.subscribe(get_channel(item.order.user.id))
+        log_in_user(item.shop.user, self.client)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('backend:partner-orders-state'),
+                             {'items': str(item.order.id), 'state': 'confirmed'})
+        assert self.get_events() == [(get_channel(item.order.user.id), {
+            'event': 'order_state_changed', 'order_id': item.order.id, 'parent_id': None, 'state': 'confirmed'})]
+
+
+class OrderEventsStreamTests(APITestCase):
+    '''Класс тестирования потока событий заказов (server-sent events)'''
+
+    def setUp(self):
+        self.user = UserFactory.create(is_active=True)
+        self.token = Token.objects.create(user=self.user)
+        # пользователь попадает в кэш авторизации, поток событий не обращается к базе данных теста
+        CachedTokenAuthentication().authenticate_credentials(self.token.key)
+
+    def run_stream(self, query_string, publish=()):
+        '''Подключиться к потоку, опубликовать события и вернуть отправленные сообщения ASGI'''
+        async def run():
+            messages = []
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {'type': 'http', 'path': '/api/v1/orders/events', 'headers': [],
+                     'query_string': query_string.encode()}
+            task = asyncio.ensure_future(order_events_application(scope, receive, send))
+            for _ in range(100):
+                if messages and hub.task is not None:
+                    break
+                await asyncio.sleep(0.02)
+            await asyncio.sleep(0.2)
+            if publish:
+                await sync_to_async(publish_order_events)(publish)
+                for _ in range(100):
+                    if len(messages) > 2:
+                        break
+                    await asyncio.sleep(0.02)
+            disconnect.set()
+            await asyncio.wait_for(task, 5)
+            return messages
+
+        return asyncio.run(run())
+
+    def test_stream_events(self):
+        '''Тест получения событий своих заказов'''
+        event = {'event': 'order_state_changed', 'order_id': 1, 'parent_id': None, 'state': 'sent'}
+        messages = self.run_stream(f'token={self.token.key}',
+                                   publish=[(self.user.id + 1, {'event': 'other'}), (self.user.id, event)])
+        assert messages[0]['status'] == 200
+        bodies = b''.join(message.get('body', b'') for message in messages[1:]).decode()
+        assert f'event: order\ndata: {json.dumps(event, separators=(",", ":"))}\n\n' in bodies
+        assert 'other' not in bodies
+
+    def test_stream_unauthenticated(self):
+        '''Тест подключения к потоку без авторизации'''
+        messages = self.run_stream('')
+        assert messages[0]['status'] == 401
+
+    @override_settings(ORDER_EVENTS_HEARTBEAT=0.05)
+    def test_stream_closed_after_token_expired(self):
+        '''Тест закрытия потока после истечения токена'''
+        async def run():
+            messages = []
+
+            async def receive():
+                await asyncio.Event().wait()
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {'type': 'http', 'path': '/api/v1/orders/events', 'headers': [],
+                     'query_string': f'token={self.token.key}'.encode()}
+            task = asyncio.ensure_future(order_events_application(scope, receive, send))
+            await asyncio.sleep(0.2)
+            assert not task.done()
+            redis_key = get_cache_key(self.token.key)
+            payload = json.loads(get_redis().get(redis_key))
+            payload['created'] = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
+            get_redis().set(redis_key, json.dumps(payload))
+            await asyncio.wait_for(task, 5)
+            return messages
+
+        messages = asyncio.run(run())
+        assert messages[-1]['body'].startswith(b'event: logout')
+        assert not messages[-1].get('more_body')
+
+
+class CeleryTopologyTests(APITestCase):
+    '''Класс тестирования очередей Celery и загрузки прайса в фоне'''
+
+    def test_task_routes(self):
+        '''Тест распределения задач по очередям'''
+        routes = {
+            'backend.tasks.partner_update_task': 'import',
+            'backend.tasks.onboard_users_task': 'import',
+            'backend.tasks.new_user_registered_task': 'email',
+            'backend.tasks.send_outbox_emails_task': 'email',
+            'backend.tasks.delete_expired_tokens_task': 'maintenance',
+        }
+        for task, queue in routes.items():
+            assert celery_app.amqp.router.route({}, task)['queue'].name == queue
+
+    class DataHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def serve_data(self):
+        '''Раздать файлы каталога data по HTTP, вернуть адрес сервера'''
+        handler = partial(self.DataHandler, directory=str(Path(__file__).resolve().parents[2] / 'data'))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    def test_partner_update_task(self):
+        '''Тест загрузки прайса поставщика задачей'''
+        user = UserFactory.create(type='shop')
+        task_id = str(uuid4())
+        partner_update_task.apply(kwargs={'user_id': user.id, 'url': f'{self.serve_data()}/shop1.yaml'},
+                                  task_id=task_id)
+        shop = Shop.objects.get(user=user)
+        assert shop.name == 'market'
+        assert ProductInfo.objects.filter(shop=shop).count() == 4
+        assert get_import_status(task_id)['state'] == 'success'
+
+    def test_partner_update_keeps_placed_orders(self):
+        '''Тест повторной загрузки прайса: позиции размещенных заказов сохраняются'''
+        user = UserFactory.create(type='shop')
+        url = f'{self.serve_data()}/shop1.yaml'
+        partner_update_task.apply(kwargs={'user_id': user.id, 'url': url})
+        product_info, removed_product_info = ProductInfo.objects.filter(shop__user=user).order_by('id')[:2]
+        order = OrderFactory.create(state='new')
+        OrderItemFactory.create(order=order, product_info=product_info, quantity=1, price=product_info.price)
+        OrderItemFactory.create(order=order, product_info=removed_product_info, quantity=1,
+                                price=removed_product_info.price)
+        ProductInfo.objects.filter(id=product_info.id).update(price=1)
+        ProductInfo.objects.filter(id=removed_product_info.id).update(external_id=1)
+        partner_update_task.apply(kwargs={'user_id': user.id, 'url': url})
+        assert OrderItem.objects.filter(order=order).count() == 2
+        assert ProductInfo.objects.get(id=product_info.id).price != 1
+        assert ProductInfo.objects.get(id=removed_product_info.id).quantity == 0
+        assert ProductInfo.objects.filter(shop__user=user).count() == 5
+        assert ProductParameter.objects.filter(product_info=product_info).count() == 4
+
+    def test_partner_update_task_failed(self):
+        '''Тест сохранения ошибки загрузки прайса для поставщика'''
+        user = UserFactory.create(type='shop')
+        log_in_user(user, self.client)
+        url = reverse('backend:partner-update')
+        file_url = f'{self.serve_data()}/missing.yaml'
+        response = self.client.post(url, {'url': file_url})
+        task_id = response.json()['Task']
+        assert self.client.get(url, {'task': task_id}).json()['State'] == 'queued'
+        partner_update_task.apply(kwargs={'user_id': user.id, 'url': file_url}, task_id=task_id)
+        response = self.client.get(url, {'task': task_id})
+        assert response.json()['State'] == 'failed'
+        assert response.json()['Error'].startswith('HTTPError: 404')
+        assert not Shop.objects.filter(user=user).exists()
+        log_in_user(UserFactory.create(type='shop'), self.client)
+        assert self.client.get(url, {'task': task_id}).status_code == 404
+
+
+class MetricsTests(APITestCase):
+    '''Класс тестирования метрик задач и очередей Celery'''
+
+    url = reverse('backend:metrics')
+
+    def setUp(self):
+        redis = get_redis()
+        redis.delete(TASK_METRICS_KEY, *redis.keys(f'{TASK_METRICS_PREFIX}*'),
+                     *[queue.name for queue in settings.CELERY_TASK_QUEUES])
+        self.user = UserFactory.create(is_staff=True)
+        log_in_user(self.user, self.client)
+
+    def test_queue_length(self):
+        '''Тест длины очереди: задача ждет в очереди maintenance'''
+        delete_expired_tokens_task.delay()
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert 'celery_queue_length{queue="maintenance"} 1\n' in response.content.decode()
+        assert 'celery_queue_length{queue="email"} 0\n' in response.content.decode()
+
+    def test_task_metrics(self):
+        '''Тест метрик выполненной задачи: результат, ожидание в очереди и время выполнения'''
+        delete_expired_tokens_task.apply(headers={'enqueued_at': time.time() - 3})
+        content = self.client.get(self.url).content.decode()
+        labels = 'task="backend.tasks.delete_expired_tokens_task"'
+        assert f'celery_tasks_total{{{labels},state="SUCCESS"}} 1\n' in content
+        assert f'celery_task_runtime_seconds_count{{{labels}}} 1\n' in content
+        assert f'celery_task_queue_wait_seconds_count{{{labels}}} 1\n' in content
+        assert f'celery_task_queue_wait_seconds_bucket{{{labels},le="2.5"}} 0\n' in content
+        assert f'celery_task_queue_wait_seconds_bucket{{{labels},le="5"}} 1\n' in content
+
+    def test_metrics_only_staff(self):
+        '''Тест метрик от лица пользователя без прав сотрудника'''
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.get(self.url)
+        assert response.status_code == 403
+
+    @override_settings(METRICS_TOKEN='metrics-secret')
+    def test_metrics_token(self):
+        '''Тест метрик с постоянным токеном METRICS_TOKEN без авторизации пользователя'''
+        client = APIClient()
+        assert client.get(self.url).status_code == 403
+        client.credentials(HTTP_AUTHORIZATION='Bearer wrong')
+        assert client.get(self.url).status_code == 403
+        client.credentials(HTTP_AUTHORIZATION='Bearer metrics-secret')
+        assert client.get(self.url).status_code == 200
+
+    def test_metrics_not_throttled(self):
+        '''Тест метрик без ограничения частоты запросов'''
+        assert MetricsView.throttle_classes == []
+
+
+class ThrottlingTests(APITestCase):
+    '''Класс тестирования ограничения частоты запросов со счетчиками в Redis'''
+
+    class Throttle(UserRateThrottle):
+        rate = '3/minute'
+        # 10 секунд от начала минутного окна: все запросы теста попадают в одно окно
+        timer = staticmethod(lambda: 1_000_000_030.0)
+
+    def setUp(self):
+        redis = get_redis()
+        keys = redis.keys('throttle_*')
+        if keys:
+            redis.delete(*keys)
+        self.user = UserFactory.create()
+
+    def make_request(self):
+        request = APIRequestFactory().get('/')
+        request.user = self.user
+        return request
+
+    def test_limit_shared_between_processes(self):
+        '''Тест общего лимита: каждый запрос проверяется новым экземпляром, как в разных процессах'''
+        results = [self.Throttle().allow_request(self.make_request(), None) for _ in range(5)]
+        assert results == [True, True, True, False, False]
+
+    def test_wait(self):
+        '''Тест времени ожидания до следующего окна'''
+        throttle = self.Throttle()
+        for _ in range(4):
+            throttle.allow_request(self.make_request(), None)
+        assert throttle.wait() == 50
+
+    def test_limit_per_user(self):
+        '''Тест раздельных лимитов пользователей'''
+        for _ in range(3):
+            self.Throttle().allow_request(self.make_request(), None)
+        self.user = UserFactory.create()
+        assert self.Throttle().allow_request(self.make_request(), None)
+
+    def test_cache_in_redis(self):
+        '''Тест кэша Django в Redis'''
+        cache.set('throttling-test', 1)
+        assert get_redis().keys('cache:*:throttling-test')
+        cache.delete('throttling-test')
@@ -0,0 +1,43 @@
+from redis.exceptions import RedisError
+from rest_framework import throttling
+
+from backend.redis_client import get_redis
+
+
+class RedisRateThrottleMixin:
+    '''Ограничение частоты запросов со счетчиком в Redis, общим для всех процессов.
+
+    Запросы считаются в окнах фиксированной длины: на запрос выполняется один INCR счетчика окна
+    (с EXPIRE в той же транзакции) вместо чтения и перезаписи списка времени запросов из кэша процесса.
+    Если Redis недоступен, запрос пропускается.
+
+    '''
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        self.now = self.timer()
+        window = int(self.now // self.duration)
+        self.window_end = (window + 1) * self.duration
+        try:
+            with get_redis().pipeline() as pipeline:
+                pipeline.incr(f'{self.key}:{window}')
+                pipeline.expire(f'{self.key}:{window}', self.duration)
+                count, _ = pipeline.execute()
+        except RedisError:
+            return True
+        return count <= self.num_requests
+
+    def wait(self):
+        return self.window_end - self.now
+
+
+class AnonRateThrottle(RedisRateThrottleMixin, throttling.AnonRateThrottle):
+    pass
+
+
+class UserRateThrottle(RedisRateThrottleMixin, throttling.UserRateThrottle):
+    pass
@@ -1,9 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from backend.views import PartnerUpdateView, PartnerStateView, PartnerOrdersView, RegisterAccountView, \
-    AccountDetailsView, LoginAccountView, \
-    CategoryViewSet, ShopViewSet, BasketView, ContactView, OrderView, ConfirmAccountView, ProductInfoViewSet
+from backend.async_views import AsyncProductInfoView, AsyncBasketView, AsyncOrderView
+from backend.views import PartnerUpdateView, PartnerStateView, PartnerOrdersView, PartnerOrdersStateView, \
+    RegisterAccountView, UserOnboardingView, AccountDetailsView, LoginAccountView, RefreshTokenView, \
+    CategoryViewSet, ShopViewSet, BasketView, BasketSummaryView, ContactView, OrderView, ConfirmAccountView, \
+    ProductInfoViewSet, MetricsView
 
 
 app_name = 'backend'
@@ -33,15 +35,24 @@ urlpatterns = [
     path('partner/update', PartnerUpdateView.as_view(), name='partner-update'),
     path('partner/state', PartnerStateView.as_view(), name='partner-state'),
     path('partner/orders', PartnerOrdersView.as_view(), name='partner-orders'),
+    path('partner/orders/state', PartnerOrdersStateView.as_view(), name='partner-orders-state'),
     path('user/register', RegisterAccountView.as_view(), name='user-register'),
+    path('user/onboarding', UserOnboardingView.as_view(), name='user-onboarding'),
     path('user/register/confirm', ConfirmAccountView.as_view(), name='user-register-confirm'),
     path('user/details', AccountDetailsView.as_view(), name='user-details'),
     path('user/login', LoginAccountView.as_view(), name='user-login'),
+    path('user/token/refresh', RefreshTokenView.as_view(), name='user-token-refresh'),
     path('user/contact', ContactView.as_view(), name='user-contact'),
     # path('categories', CategoryView.as_view(), name='categories'),
     # path('shops', ShopView.as_view(), name='shops'),
     # path('products', ProductInfoView.as_view(), name='products'),
     path('basket', BasketView.as_view(), name='basket'),
+    path('basket/summary', BasketSummaryView.as_view(), name='basket-summary'),
     path('orders', OrderView.as_view(), name='orders'),
+    path('products/search', product_info, name='products-search'),
+    path('async/products', AsyncProductInfoView.as_view(), name='async-products'),
+    path('async/basket', AsyncBasketView.as_view(), name='async-basket'),
+    path('async/orders', AsyncOrderView.as_view(), name='async-orders'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('', include(router.urls))
 ]
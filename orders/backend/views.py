@@ -1,39 +1,155 @@
+from datetime import datetime, time, timedelta
 from distutils.util import strtobool
+from hmac import compare_digest
+from io import TextIOWrapper
+from uuid import uuid4
 
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.db import IntegrityError
-from django.db.models import Sum, F, Q
-from django.http import JsonResponse
+from django.db import IntegrityError, transaction
+from django.db.models import Q, F, Sum, Count, Case, When, Value, PositiveIntegerField, OuterRef, Subquery, Prefetch, \
+    Exists
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from drf_spectacular.utils import extend_schema, OpenApiParameter
-from requests import get
-from rest_framework.authentication import TokenAuthentication
+from redis.exceptions import LockError
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
 from rest_framework.authtoken.models import Token
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
-from yaml import load as load_yaml, Loader
 from ujson import loads as load_json
 
-from backend.models import Shop, Category, ProductInfo, Product, Parameter, ProductParameter, Order, OrderItem, \
-    Contact, ConfirmEmailToken
+from backend.authentication import get_token_expires, is_token_expired
+from backend.basket import RedisBasket
+from backend.events import get_order_created_events, get_order_state_events, publish_order_events
+from backend.hashers import hash_password, PasswordHashingBusy
+from backend.idempotency import idempotent
+from backend.metrics import render_metrics
+from backend.onboarding import read_users_csv, validate_users
+from backend.models import Shop, Category, ProductInfo, Order, OrderItem, User, Contact, ConfirmEmailToken, \
+    EmailOutbox, STATE_CHOICES, PARTNER_STATES
+from backend.pagination import OrderCursorPagination
 from backend.serializers import UserSerializer, ShopSerializer, OrderSerializer, CategorySerializer, \
-    ProductInfoSerializer, OrderItemSerializer, ContactSerializer
+    ProductInfoSerializer, ContactSerializer, PartnerOrderSerializer
 # from backend.signals import new_user_registered, new_order
-from backend.tasks import new_user_registered_task, new_order_task
+from backend.tasks import new_user_registered_task, partner_update_task, onboard_users_task, get_import_status, \
+    set_import_status, set_onboarding_rows
+
+
+def get_dt_query(dt_from, dt_to):
+    '''Фильтр заказов по дате создания.
+
+    Принимает дату или дату и время в формате ISO 8601.
+    Если передана только дата, граница dt_to включает весь этот день.
+
+    '''
+    query = Q()
+    if dt_from:
+        value, _ = parse_dt(dt_from)
+        query = query & Q(dt__gte=value)
+    if dt_to:
+        value, is_date = parse_dt(dt_to)
+        if is_date:
+            query = query & Q(dt__lt=value + timedelta(days=1))
+        else:
+            query = query & Q(dt__lte=value)
+    return query
+
+
+def parse_dt(value):
+    '''Преобразование строки в datetime с часовым поясом.
+
+    Возвращает datetime и признак того, что в строке была передана только дата.
+
+    '''
+    try:
+        date = parse_date(value)
+        is_date = date is not None
+        dt = datetime.combine(date, time.min) if is_date else parse_datetime(value)
+    except ValueError:
+        dt = None
+    if dt is None:
+        raise ValueError(f'Wrong date format: {value}')
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt, is_date
+
+
+def get_product_infos(shop_id=None, category_id=None):
+    '''Товары активных магазинов с фильтром по магазину и категории'''
+    query = Q(shop__state=True)
+    if shop_id:
+        query = query & Q(shop_id=shop_id)
+    if category_id:
+        query = query & Q(product__category_id=category_id)
+    return ProductInfo.objects.filter(query).select_related(
+        'shop', 'product__category').prefetch_related('product_parameters__parameter').distinct()
+
+
+def get_basket(user_id):
+    '''Корзина пользователя, хранящаяся в базе данных'''
+    return Order.objects.filter(
+        user_id=user_id, state='basket').prefetch_related(
+        'ordered_items__product_info__product__category',
+        'ordered_items__product_info__product_parameters__parameter', 'sub_orders').select_related('contact')
+
+
+def get_orders(user_id, state=None, dt_from=None, dt_to=None):
+    '''Заказы пользователя (кроме корзины) вместе с заказами по магазинам.
+
+    При неверном статусе или формате даты вызывает ValueError.
+
+    '''
+    query = Q(user_id=user_id) & ~Q(state='basket')
+    if state:
+        if state not in dict(STATE_CHOICES) or state == 'basket':
+            raise ValueError('Wrong state')
+        query = query & Q(state=state)
+    query = query & get_dt_query(dt_from, dt_to)
+    return Order.objects.filter(query, parent__isnull=True).prefetch_related(
+        'ordered_items__product_info__product__category',
+        'ordered_items__product_info__product_parameters__parameter',
+        'sub_orders__ordered_items__product_info__product__category',
+        'sub_orders__ordered_items__product_info__product_parameters__parameter').select_related('contact')
 
 
 class PartnerUpdateView(APIView):
     '''Класс для обновления прайса от поставщика.'''
 
+    def get(self, request, *args, **kwargs):
+        '''Получить статус загрузки прайса методом GET.
+
+        Для использования необходима авторизация от лица поставщика.
+        В query string необходимо указать task - id задачи из ответа на запрос POST.
+        Статус (State): queued, started, success или failed с текстом ошибки (Error).
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        if request.user.type != 'shop':
+            return JsonResponse({'Status': False, 'Error': 'Only shops'}, status=403)
+        task_id = request.query_params.get('task')
+        if not task_id:
+            return JsonResponse({'Status': False, 'Errors': 'Need more arguments'})
+        status = get_import_status(task_id)
+        if status is None or status['user_id'] != str(request.user.id):
+            return JsonResponse({'Status': False, 'Error': 'Task not found'}, status=404)
+        return JsonResponse({'Status': True, 'State': status['state'], 'Error': status['error']})
+
     def post(self, request, *args, **kwargs):
         '''Обновление прайса поставщика методом POST.
 
         Для использования необходима авторизация от лица поставщика.
         В запросе необходимо указать url файла ".yaml", в котором находится информация для обновления.
+        Прайс загружается в фоне задачей Celery в очереди import,
+        в ответе возвращается id задачи (Task) для проверки статуса загрузки методом GET.
 
         '''
         if not request.user.is_authenticated:
@@ -48,29 +164,10 @@ class PartnerUpdateView(APIView):
             except ValidationError as e:
                 return JsonResponse({'Status': False, 'Error': str(e)})
             else:
-                stream = get(url).content
-                data = load_yaml(stream, Loader=Loader)
-                shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=request.user.id)
-                for category in data['categories']:
-                    category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                    category_object.shops.add(shop.id)
-                    category_object.save()
-                ProductInfo.objects.filter(shop_id=shop.id).delete()
-                for item in data['goods']:
-                    product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-                    product_info = ProductInfo.objects.create(product_id=product.id,
-                                                              external_id=item['id'],
-                                                              model=item['model'],
-                                                              price=item['price'],
-                                                              price_rrc=item['price_rrc'],
-                                                              quantity=item['quantity'],
-                                                              shop_id=shop.id)
-                    for name, value in item['parameters'].items():
-                        parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                        ProductParameter.objects.create(product_info_id=product_info.id,
-                                                        parameter_id=parameter_object.id,
-                                                        value=value)
-                return JsonResponse({'Status': True})
+                task_id = str(uuid4())
+                set_import_status(task_id, request.user.id, 'queued')
+                partner_update_task.apply_async(kwargs={'user_id': request.user.id, 'url': url}, task_id=task_id)
+                return JsonResponse({'Status': True, 'Task': task_id})
         return JsonResponse({'Status': False, "Errors": 'Need more arguments'})
 
 
@@ -116,24 +213,105 @@ class PartnerStateView(APIView):
 class PartnerOrdersView(APIView):
     '''Класс для работы поставщиков с заказами'''
 
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='state', description='Order state', required=False, type=str),
+            OpenApiParameter(name='cursor', description='Page cursor from "next" or "previous" links',
+                             required=False, type=str),
+        ],
+        responses=PartnerOrderSerializer(many=True),
+    )
     def get(self, request, *args, **kwargs):
         '''Получить заказы методом GET.
 
         Необходима авторизация от лица поставшика.
-        На выходе дает активные заказы текущего поставщика.
+        На выходе дает активные заказы текущего поставщика постранично, от новых к старым.
+        В заказах показываются только позиции и сумма текущего поставщика.
+        В query string можно передать:
+            state - статус заказа
 
         '''
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
         if request.user.type != 'shop':
             return JsonResponse({'Status': False, 'Error': 'For shops only'}, status=403)
-        order = Order.objects.filter(
-            ordered_items__product_info__shop__user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').select_related('contact').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        shop = Shop.objects.filter(user_id=request.user.id).first()
+        if shop is None:
+            return JsonResponse({'Status': False, 'Error': 'Shop not found'})
+        query = ~Q(state='basket')
+        state = request.query_params.get('state')
+        if state:
+            if state not in dict(STATE_CHOICES) or state == 'basket':
+                return JsonResponse({'Status': False, 'Error': 'Wrong state'})
+            query = query & Q(state=state)
+        shop_items = OrderItem.objects.filter(shop_id=shop.id)
+        shop_sum = shop_items.filter(order_id=OuterRef('id')).values('order_id').annotate(
+            shop_sum=Sum(F('quantity') * F('price'))).values('shop_sum')
+        orders = Order.objects.filter(query, id__in=shop_items.values('order_id')).annotate(
+            shop_sum=Subquery(shop_sum)).prefetch_related(
+            Prefetch('ordered_items', queryset=shop_items.select_related(
+                'product_info__product__category').prefetch_related(
+                'product_info__product_parameters__parameter'))).select_related('contact')
+        paginator = OrderCursorPagination()
+        page = paginator.paginate_queryset(orders, request, view=self)
+        serializer = PartnerOrderSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class PartnerOrdersStateView(APIView):
+    '''Класс для изменения поставщиком статусов заказов'''
+
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        '''Изменить статус заказов методом POST.
+
+        Необходима авторизация от лица поставщика.
+        Необходимо передать:
+            items - id заказов через запятую,
+            state - новый статус заказов
+        Необязательный параметр expected - текущий статус заказов.
+        Статус меняется одним запросом только у заказов поставщика, для которых допустим переход в новый статус.
+        Заказы, в которых есть позиции других магазинов, не изменяются.
+        При отмене заказа товары возвращаются на склад.
+        Статус основного заказа покупателя пересчитывается по статусам его заказов по магазинам.
+        Покупатели получают уведомление о новом статусе заказа.
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        if request.user.type != 'shop':
+            return JsonResponse({'Status': False, 'Error': 'For shops only'}, status=403)
+        if {'items', 'state'}.issubset(request.data):
+            state = request.data['state']
+            if state not in PARTNER_STATES:
+                return JsonResponse({'Status': False, 'Error': 'Wrong state'})
+            previous_states = Order.get_previous_states(state)
+            expected = request.data.get('expected')
+            if expected:
+                if expected not in previous_states:
+                    return JsonResponse({'Status': False, 'Error': f'Can"t change state from {expected} to {state}'})
+                previous_states = [expected]
+            order_ids = [order_id for order_id in str(request.data['items']).split(',') if order_id.isdigit()]
+            if order_ids:
+                shop_orders = OrderItem.objects.filter(shop__user_id=request.user.id).values('order_id')
+                # заказы с позициями других магазинов поставщик менять не может
+                other_shop_items = OrderItem.objects.filter(order_id=OuterRef('id')).exclude(
+                    shop__user_id=request.user.id)
+                with transaction.atomic():
+                    order_ids = list(Order.objects.select_for_update().filter(
+                        id__in=order_ids, state__in=previous_states).filter(
+                        id__in=shop_orders).filter(~Exists(other_shop_items)).values_list('id', flat=True))
+                    if state == 'canceled':
+                        OrderItem.objects.release(order_ids)
+                    updated_count = Order.objects.filter(id__in=order_ids, state__in=previous_states).update(
+                        state=state)
+                    if updated_count:
+                        Order.update_parent_states(order_ids)
+                        EmailOutbox.objects.add('order_state_changed', order_ids, state=state)
+                        events = get_order_state_events(order_ids, state)
+                        transaction.on_commit(lambda: publish_order_events(events))
+                return JsonResponse({'Status': True, 'Update': f'{updated_count} orders'})
+        return JsonResponse({'Status': False, 'Error': 'Need more arguments'})
 
 
 class RegisterAccountView(APIView):
@@ -166,9 +344,11 @@ class RegisterAccountView(APIView):
                 request.data.update({})
                 user_serializer = UserSerializer(data=request.data)
                 if user_serializer.is_valid():
-                    user = user_serializer.save()
-                    user.set_password(request.data['password'])
-                    user.save()
+                    try:
+                        password = hash_password(request.data['password'])
+                    except PasswordHashingBusy:
+                        return JsonResponse({'Status': False, 'Error': 'Server is busy'}, status=503)
+                    user = user_serializer.save(password=password)
                     new_user_registered_task.delay(user_id=user.id)
                     # new_user_registered.send(sender=self.__class__, user_id=user.id)
                     return JsonResponse({'Status': True})
@@ -177,6 +357,68 @@ class RegisterAccountView(APIView):
         return JsonResponse({'Status': False, 'Errors': 'Need more register arguments'}, status=200)
 
 
+class UserOnboardingView(APIView):
+    '''Класс для массовой регистрации сотрудников корпоративных покупателей.'''
+
+    def get(self, request, *args, **kwargs):
+        '''Получить статус регистрации пользователей методом GET.
+
+        Необходима авторизация от лица сотрудника сервиса.
+        В query string необходимо указать task - id задачи из ответа на запрос POST.
+        Статус (State): queued, started, success или failed с ошибками строк файла (Error).
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        if not request.user.is_staff:
+            return JsonResponse({'Status': False, 'Error': 'Only staff'}, status=403)
+        task_id = request.query_params.get('task')
+        if not task_id:
+            return JsonResponse({'Status': False, 'Errors': 'Need more arguments'})
+        status = get_import_status(task_id)
+        if status is None or status['user_id'] != str(request.user.id):
+            return JsonResponse({'Status': False, 'Error': 'Task not found'}, status=404)
+        return JsonResponse({'Status': True, 'State': status['state'], 'Error': status['error']})
+
+    def post(self, request, *args, **kwargs):
+        '''Регистрация пользователей из CSV-файла методом POST.
+
+        Необходима авторизация от лица сотрудника сервиса.
+        Необходимо передать файл file с колонками:
+            first_name,
+            last_name,
+            email,
+            company,
+            position,
+            password
+
+        Строки файла проверяются сразу, пользователи создаются, только если все строки корректны.
+        Пароли хешируются в фоне задачей Celery в очереди import,
+        в ответе возвращается id задачи (Task) для проверки статуса методом GET.
+        По результату отправляет письма с токенами для подтверждения.
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        if not request.user.is_staff:
+            return JsonResponse({'Status': False, 'Error': 'Only staff'}, status=403)
+        file = request.FILES.get('file')
+        if file is None:
+            return JsonResponse({'Status': False, 'Errors': 'Need more arguments'})
+        try:
+            rows = read_users_csv(TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+        except (UnicodeDecodeError, ValidationError) as e:
+            return JsonResponse({'Status': False, 'Error': str(e)})
+        _, _, errors = validate_users(rows)
+        if errors:
+            return JsonResponse({'Status': False, 'Errors': errors})
+        task_id = str(uuid4())
+        set_onboarding_rows(task_id, rows)
+        set_import_status(task_id, request.user.id, 'queued')
+        onboard_users_task.apply_async(kwargs={'user_id': request.user.id}, task_id=task_id)
+        return JsonResponse({'Status': True, 'Task': task_id})
+
+
 class ConfirmAccountView(APIView):
     '''Класс подтверждения адреса электронной почты.'''
 
@@ -189,6 +431,9 @@ class ConfirmAccountView(APIView):
         if {'email', 'token'}.issubset(request.data):
             token = ConfirmEmailToken.objects.filter(user__email=request.data['email'],
                                                      key=request.data['token']).first()
+            if token and token.is_expired():
+                # истекший токен вместе с неподтвержденным пользователем удаляет периодическая задача
+                return JsonResponse({'Status': False, 'Error': 'Token has expired'})
             if token:
                 token.user.is_active = True
                 token.user.save()
@@ -211,7 +456,8 @@ class AccountDetailsView(APIView):
         '''
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        serializer = UserSerializer(request.user)
+        # в request.user из кэша авторизации только поля для проверки доступа
+        serializer = UserSerializer(User.objects.prefetch_related('contacts').get(id=request.user.id))
         return Response(serializer.data)
 
     def post(self, request, *args, **kwargs):
@@ -223,6 +469,7 @@ class AccountDetailsView(APIView):
         '''
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        user = User.objects.get(id=request.user.id)
         if 'password' in request.data:
             try:
                 validate_password(request.data['password'])
@@ -232,9 +479,12 @@ class AccountDetailsView(APIView):
                     error_array.append(item)
                 return JsonResponse({'Status': False, 'Errors': {'password': error_array}}, status=200)
             else:
-                request.user.set_password(request.data['password'])
+                try:
+                    user.password = hash_password(request.data['password'])
+                except PasswordHashingBusy:
+                    return JsonResponse({'Status': False, 'Error': 'Server is busy'}, status=503)
 
-        user_serializer = UserSerializer(request.user, data=request.data, partial=True)
+        user_serializer = UserSerializer(user, data=request.data, partial=True)
         if user_serializer.is_valid():
             user_serializer.save()
             return JsonResponse({'Status': True})
@@ -245,6 +495,9 @@ class AccountDetailsView(APIView):
 class LoginAccountView(APIView):
     '''Класс для авторизации пользователей'''
 
+    # вход по паролю не должен зависеть от переданного истекшего токена
+    authentication_classes = []
+
     def post(self, request, *args, **kwargs):
         '''Авторизация пользователя методом POST.
 
@@ -253,15 +506,40 @@ class LoginAccountView(APIView):
 
         '''
         if {'email', 'password'}.issubset(request.data):
-            user = authenticate(request, username=request.data['email'], password=request.data['password'])
+            try:
+                user = authenticate(request, username=request.data['email'], password=request.data['password'])
+            except PasswordHashingBusy:
+                return JsonResponse({'Status': False, 'Error': 'Server is busy'}, status=503)
             if user is not None:
                 if user.is_active:
-                    token, _ = Token.objects.get_or_create(user=user)
-                    return JsonResponse({'Status': True, 'Token': token.key})
+                    with transaction.atomic():
+                        token, created = Token.objects.select_for_update().get_or_create(user=user)
+                        if not created and is_token_expired(token):
+                            token.delete()
+                            token = Token.objects.create(user=user)
+                    return JsonResponse({'Status': True, 'Token': token.key,
+                                         'Expires': get_token_expires(token).isoformat()})
                 return JsonResponse({'Status': False, 'Errors': 'Can"t authenticate'}, status=200)
             return JsonResponse({'Status': False, 'Errors': 'Need more uthenticate arguments'}, status=200)
 
 
+class RefreshTokenView(APIView):
+    '''Класс для обновления токена авторизации'''
+
+    def post(self, request, *args, **kwargs):
+        '''Обновление токена методом POST.
+
+        Текущий токен удаляется, на выходе дает новый token авторизации.
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        with transaction.atomic():
+            Token.objects.filter(key=request.auth.key).delete()
+            token = Token.objects.create(user=request.user)
+        return JsonResponse({'Status': True, 'Token': token.key, 'Expires': get_token_expires(token).isoformat()})
+
+
 # class CategoryView(ListAPIView):
 #
 #     queryset = Category.objects.all()
@@ -315,21 +593,16 @@ class ProductInfoViewSet(ModelViewSet):
 
         Используется метод GET.
         В query string можно передать:
-            id магазина
-            id категории
+            shop_id - id магазина,
+            category_id - id категории,
+            page - номер страницы
 
         '''
-        query = Q(shop__state=True)
-        shop_id = request.query_params.get('shop_id')
-        category_id = request.query_params.get('category_id')
-        if shop_id:
-            query = query & Q(shop_id=shop_id)
-        if category_id:
-            query = query & Q(product__category_id=category_id)
-        queryset = ProductInfo.objects.filter(query).select_related(
-            'shop', 'product__category').prefetch_related('product_parameters__parameter').distinct()
-        serializer = ProductInfoSerializer(queryset, many=True)
-        return Response(serializer.data)
+        queryset = get_product_infos(request.query_params.get('shop_id'),
+                                     request.query_params.get('category_id')).order_by('id')
+        page = self.paginate_queryset(queryset)
+        serializer = ProductInfoSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
 
 class BasketView(APIView):
@@ -346,22 +619,23 @@ class BasketView(APIView):
         '''
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        basket = Order.objects.filter(
-            user_id=request.user.id, state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
-        serializer = OrderSerializer(basket, many=True)
+        if settings.BASKET_STORAGE == 'redis':
+            return Response([RedisBasket(request.user.id).get_data()])
+        serializer = OrderSerializer(get_basket(request.user.id), many=True)
         return Response(serializer.data)
 
     @extend_schema(
         parameters=[
             OpenApiParameter(name='items', description='All added in basket items like '
                                                        '"[{"product_info": 25, "quantity": 13},...]"',
-                             required=True, type=str)
+                             required=True, type=str),
+            OpenApiParameter(name='mode', description='"add" to increment quantity of items already in basket '
+                                                      '(default), "set" to replace it',
+                             required=False, type=str),
         ],
         responses=OrderSerializer,
     )
+    @idempotent
     def post(self, request, *args, **kwargs):
         '''Редактировать корзину методом post.
 
@@ -370,39 +644,55 @@ class BasketView(APIView):
             Где:
                 x - id информации о продукте,
                 y - количество товара
+        Необязательный параметр mode:
+            add - прибавить количество к товару, который уже есть в корзине (по умолчанию),
+            set - заменить количество товара в корзине
 
         '''
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
         items_string = request.data.get('items')
         if items_string:
+            mode = request.data.get('mode', 'add')
+            if mode not in ('add', 'set'):
+                return JsonResponse({'Status': False, 'Error': 'Wrong mode'})
             try:
                 items_dict = load_json(items_string)
             except ValueError:
                 return JsonResponse({'Status': False, 'Error': 'Wrong format'})
             else:
-                basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
-                objects_created = 0
+                if type(items_dict) != list:
+                    return JsonResponse({'Status': False, 'Error': 'Wrong format'})
+                quantities = {}
                 for order_item in items_dict:
-                    order_item.update({'order': basket.id})
-                    serializer = OrderItemSerializer(data=order_item)
-                    if serializer.is_valid():
-                        try:
-                            serializer.save()
-                        except IntegrityError as error:
-                            return JsonResponse({'Status': False, 'Error': str(error)})
-                        else:
-                            objects_created += 1
+                    if type(order_item) != dict or type(order_item.get('product_info')) != int \
+                            or type(order_item.get('quantity')) != int or order_item['quantity'] <= 0:
+                        return JsonResponse({'Status': False, 'Error': 'Wrong format'})
+                    if mode == 'add':
+                        quantities[order_item['product_info']] = \
+                            quantities.get(order_item['product_info'], 0) + order_item['quantity']
                     else:
-                        return JsonResponse({'Status': False, 'Error': serializer.errors})
-
+                        quantities[order_item['product_info']] = order_item['quantity']
+                product_infos = ProductInfo.objects.only('price', 'shop_id').in_bulk(quantities)
+                missing = [product_info_id for product_info_id in quantities if product_info_id not in product_infos]
+                if missing:
+                    return JsonResponse({'Status': False, 'Error': f'Product info not found: {missing}'})
+                if settings.BASKET_STORAGE == 'redis':
+                    objects_created = RedisBasket(request.user.id).add(quantities, increment=mode == 'add')
+                    return JsonResponse({'Status': True, 'Add in basket': f'{objects_created} products'})
+                basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
+                objects_created = OrderItem.objects.upsert(basket.id, quantities, product_infos,
+                                                           increment=mode == 'add')
+                basket.update_total_sum()
                 return JsonResponse({'Status': True, 'Add in basket': f'{objects_created} products'})
         return JsonResponse({'Status': False, 'Error': 'Need more arguments'})
 
+    @idempotent
     def delete(self, request, *args, **kwargs):
         '''Удалить товары из корзины методом DELETE.
 
         Необходимо передать id удаляемых товаров через запятую.
+        При хранении корзины в Redis передаются id информации о продуктах.
 
         '''
         if not request.user.is_authenticated:
@@ -410,6 +700,12 @@ class BasketView(APIView):
         items_string = request.data.get('items')
         if items_string:
             items_list = items_string.split(',')
+            if settings.BASKET_STORAGE == 'redis':
+                product_info_ids = [product_info_id for product_info_id in items_list if product_info_id.isdigit()]
+                if product_info_ids:
+                    deleted_count = RedisBasket(request.user.id).delete(product_info_ids)
+                    return JsonResponse({'Status': True, 'Delete': f'{deleted_count} items'})
+                return JsonResponse({'Status': False, 'Error': 'Need more arguments'})
             basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
             query = Q()
             objects_deleted = False
@@ -419,9 +715,11 @@ class BasketView(APIView):
                     objects_deleted = True
             if objects_deleted:
                 deleted_count = OrderItem.objects.filter(query).delete()[0]
+                basket.update_total_sum()
                 return JsonResponse({'Status': True, 'Delete': f'{deleted_count} items'})
             return JsonResponse({'Status': False, 'Error': 'Need more arguments'})
 
+    @idempotent
     def put(self, request, *args, **kwargs):
         '''Редактировать количество товаров в корзине методом PUT.
 
@@ -429,6 +727,8 @@ class BasketView(APIView):
             [ { "id": x, "quantity": y }, ... ] , где:
                 x - id  редактируемого товара,
                 y - какое количество товара добавить
+        Все позиции обновляются одним запросом к базе данных.
+        При хранении корзины в Redis в качестве x передается id информации о продукте.
 
         '''
         if not request.user.is_authenticated:
@@ -440,16 +740,51 @@ class BasketView(APIView):
             except ValueError:
                 return JsonResponse({'Status': False, "Errors": 'Invalid format'})
             else:
+                if type(items_dict) != list:
+                    return JsonResponse({'Status': False, 'Error': 'Wrong format'})
+                quantities = {}
+                for order_item in items_dict:
+                    if type(order_item) != dict:
+                        return JsonResponse({'Status': False, 'Error': 'Wrong format'})
+                    if type(order_item.get('id')) == int and type(order_item.get('quantity')) == int \
+                            and order_item['quantity'] > 0:
+                        quantities[order_item['id']] = order_item['quantity']
+                if settings.BASKET_STORAGE == 'redis':
+                    objects_updated = RedisBasket(request.user.id).update(quantities) if quantities else 0
+                    return JsonResponse({'Status': True, 'Update': f'{objects_updated} items'})
                 basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
                 objects_updated = 0
-                for order_item in items_dict:
-                    if type(order_item['id']) == int and type(order_item['quantity']) == int:
-                        objects_updated += OrderItem.objects.filter(order_id=basket.id, id=order_item['id']).update(
-                            quantity=order_item['quantity'])
+                if quantities:
+                    objects_updated = OrderItem.objects.filter(order_id=basket.id, id__in=quantities).update(
+                        quantity=Case(*[When(id=item_id, then=Value(quantity))
+                                        for item_id, quantity in quantities.items()],
+                                      output_field=PositiveIntegerField()))
+                    basket.update_total_sum()
                 return JsonResponse({'Status': True, 'Update': f'{objects_updated} items'})
         return JsonResponse({'Status': False, 'Error': 'Need more arguments'})
 
 
+class BasketSummaryView(APIView):
+    '''Класс для краткой информации о корзине пользователя'''
+
+    def get(self, request, *args, **kwargs):
+        '''Получить краткую информацию о корзине методом GET.
+
+        Необходима авторизация от лица покупателя.
+        На выходе дает количество позиций, количество единиц товара и сумму корзины.
+
+        '''
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+        if settings.BASKET_STORAGE == 'redis':
+            return Response(RedisBasket(request.user.id).get_summary())
+        summary = OrderItem.objects.filter(order__user_id=request.user.id, order__state='basket').aggregate(
+            lines_count=Count('id'),
+            units_count=Coalesce(Sum('quantity'), 0),
+            total_sum=Coalesce(Sum(F('quantity') * F('price')), 0))
+        return Response(summary)
+
+
 class ContactView(APIView):
     '''Класс для работы с контактами покупателей'''
 
@@ -541,21 +876,42 @@ class ContactView(APIView):
 class OrderView(APIView):
     '''Класс для работы пользователей с заказами'''
 
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='state', description='Order state', required=False, type=str),
+            OpenApiParameter(name='dt_from', description='Orders created since date or datetime (ISO 8601)',
+                             required=False, type=str),
+            OpenApiParameter(name='dt_to', description='Orders created until date or datetime (ISO 8601)',
+                             required=False, type=str),
+            OpenApiParameter(name='cursor', description='Page cursor from "next" or "previous" links',
+                             required=False, type=str),
+        ],
+        responses=OrderSerializer(many=True),
+    )
     def get(self, request, *args, **kwargs):
         '''Получить заказы пользователя методом GET.
 
         Необходима авторизация от лица покупателя.
+        Заказы выдаются постранично, от новых к старым, вместе с заказами по магазинам.
+        В query string можно передать:
+            state - статус заказа,
+            dt_from - дата или дата и время, начиная с которой созданы заказы,
+            dt_to - дата или дата и время, до которой созданы заказы
 
         '''
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        orders = Order.objects.filter(user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').select_related('contact').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
-
+        try:
+            orders = get_orders(request.user.id, request.query_params.get('state'),
+                                request.query_params.get('dt_from'), request.query_params.get('dt_to'))
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Error': str(error)})
+        paginator = OrderCursorPagination()
+        page = paginator.paginate_queryset(orders, request, view=self)
+        serializer = OrderSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @idempotent
     def post(self, request, *args, **kwargs):
         '''Разместить заказ из корзины методом POST.
 
@@ -563,22 +919,88 @@ class OrderView(APIView):
         Необходимо передать id заказа.
         Заказ должен быть в статусте "basket".
         Необходимо указать контакты покупателя.
+        Товары заказа резервируются на складе, если какого-то товара недостаточно - заказ не размещается.
+        Заказ разделяется на заказы по магазинам, каждый магазин получает уведомление о своем заказе.
+        При хранении корзины в Redis id заказа не передается, заказ создается из корзины в Redis.
 
         '''
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        if {'id', 'contact'}.issubset(request.data):
-            if request.data['id'].isdigit():
+        if settings.BASKET_STORAGE == 'redis':
+            if 'contact' in request.data:
+                redis_basket = RedisBasket(request.user.id)
                 try:
-                    is_updated = Order.objects.filter(
-                        user_id=request.user.id, id=request.data['id']).update(
-                        contact_id=request.data['contact'],
-                        state='new')
-                except IntegrityError as error:
-                    return JsonResponse({'Status': False, 'Error': 'Wrong arguments'})
-                else:
-                    if is_updated:
-                        new_order_task.delay(user_id=request.user.id)
-                        # new_order.send(sender=self.__class__, user_id=request.user.id)
-                        return JsonResponse({'Status': True})
+                    with redis_basket.lock():
+                        return self.place_order(request, redis_basket=redis_basket)
+                except LockError:
+                    return JsonResponse({'Status': False, 'Error': 'Basket is locked'}, status=409)
+        elif {'id', 'contact'}.issubset(request.data):
+            if request.data['id'].isdigit():
+                return self.place_order(request)
         return JsonResponse({'Status': 'Need more arguments'})
+
+    def place_order(self, request, redis_basket=None):
+        '''Разместить заказ из корзины в базе данных или, если передана, из корзины в Redis.'''
+        try:
+            with transaction.atomic():
+                if redis_basket is None:
+                    basket = Order.objects.select_for_update().filter(
+                        user_id=request.user.id, id=request.data['id'], state='basket').first()
+                    unavailable = []
+                else:
+                    basket, unavailable = redis_basket.materialize()
+                if basket is None:
+                    return JsonResponse({'Status': False, 'Error': 'Basket not found'})
+                unavailable += basket.reserve_items()
+                if unavailable:
+                    transaction.set_rollback(True)
+                    return JsonResponse({'Status': False, 'Error': 'Not enough products in stock',
+                                         'Items': unavailable})
+                basket.update_prices()
+                basket.contact_id = request.data['contact']
+                basket.state = 'new'
+                basket.save(update_fields=['contact', 'state'])
+                sub_orders = basket.split_by_shops()
+                EmailOutbox.objects.add('new_order', [basket.id])
+                EmailOutbox.objects.add('new_sub_order', [sub_order.id for sub_order in sub_orders],
+                                        delay=settings.PARTNER_NOTIFICATION_WINDOW)
+                events = get_order_created_events(basket, sub_orders)
+                transaction.on_commit(lambda: publish_order_events(events))
+                if redis_basket is not None:
+                    transaction.on_commit(lambda: redis_basket.remove(redis_basket.ordered))
+        except IntegrityError as error:
+            return JsonResponse({'Status': False, 'Error': 'Wrong arguments'})
+        else:
+            # new_order.send(sender=self.__class__, user_id=request.user.id)
+            return JsonResponse({'Status': True})
+
+
+class MetricsView(APIView):
+    '''Класс для просмотра метрик задач и очередей Celery'''
+
+    # Prometheus опрашивает метрики постоянно, ограничение частоты запросов к ним не применяется
+    throttle_classes = []
+
+    def get(self, request, *args, **kwargs):
+        '''Получить метрики методом GET в текстовом формате Prometheus.
+
+        Необходима авторизация заголовком "Authorization: Bearer <METRICS_TOKEN>"
+        или от лица сотрудника сервиса.
+        Возвращает длину каждой очереди, количество выполненных задач по результату,
+        гистограммы времени ожидания в очереди и времени выполнения задач.
+
+        '''
+        if not self.has_metrics_token(request):
+            if not request.user.is_authenticated:
+                return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+            if not request.user.is_staff:
+                return JsonResponse({'Status': False, 'Error': 'Only staff'}, status=403)
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @staticmethod
+    def has_metrics_token(request):
+        '''Передан ли в запросе постоянный токен METRICS_TOKEN'''
+        auth = get_authorization_header(request).split()
+        if not settings.METRICS_TOKEN or len(auth) != 2 or auth[0].lower() != b'bearer':
+            return False
+        return compare_digest(auth[1], settings.METRICS_TOKEN.encode())
@@ -0,0 +1,82 @@
+'''Сравнение времени запроса к базе данных с новым и постоянным соединением.
+
+Использует настройки базы данных из .env (DB_*), сервер приложения не нужен:
+цикл запроса имитируется сигналами request_started/request_finished, как в обработчике Django.
+Запуск:
+    python benchmarks/db_connections.py --requests 2000
+    DB_HOST=127.0.0.1 DB_PORT=6432 DB_POOLER=pgbouncer python benchmarks/db_connections.py
+
+Для CONN_MAX_AGE=0 (новое соединение на каждый запрос) и постоянного соединения
+выводит среднее время, медиану и 99-й перцентиль времени запроса и среднюю экономию на запросе.
+Режим persistent/thread выполняет каждый запрос в новом потоке, как обработчик ASGI:
+соединение потока больше не используется, и постоянные соединения не дают экономии.
+
+'''
+import argparse
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orders.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.signals import request_finished, request_started  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from backend.models import ProductInfo  # noqa: E402
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def request(latencies):
+    start = time.perf_counter()
+    request_started.send(sender=None)
+    ProductInfo.objects.filter(quantity__gt=0).exists()
+    request_finished.send(sender=None)
+    latencies.append((time.perf_counter() - start) * 1000)
+
+
+def run(conn_max_age, requests_count, thread_per_request=False):
+    '''Выполнить requests_count запросов с заданным CONN_MAX_AGE, вернуть время каждого в миллисекундах'''
+    connection.close()
+    connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+    latencies = []
+    for _ in range(requests_count):
+        if thread_per_request:
+            thread = threading.Thread(target=request, args=(latencies,))
+            thread.start()
+            thread.join()
+        else:
+            request(latencies)
+    connection.close()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000, help='Число запросов в каждом режиме')
+    parser.add_argument('--conn-max-age', type=int, default=60, help='CONN_MAX_AGE постоянного соединения')
+    args = parser.parse_args()
+
+    print(f'{"mode":<20}{"mean, ms":>10}{"p50, ms":>10}{"p99, ms":>10}')
+    results = {}
+    for mode, conn_max_age, thread_per_request in (('new', 0, False), ('persistent', args.conn_max_age, False),
+                                                   ('persistent/thread', args.conn_max_age, True)):
+        latencies = results[mode] = run(conn_max_age, args.requests, thread_per_request)
+        mean = sum(latencies) / len(latencies)
+        print(f'{mode:<20}{mean:>10.2f}{percentile(latencies, 50):>10.2f}{percentile(latencies, 99):>10.2f}')
+    saving = (sum(results['new']) - sum(results['persistent'])) / args.requests
+    print(f'saving per request: {saving:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
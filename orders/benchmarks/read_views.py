@@ -0,0 +1,83 @@
+'''Сравнение синхронных и асинхронных представлений для чтения под нагрузкой.
+
+Серверы запускаются отдельно, например:
+    gunicorn orders.wsgi -w 4 --threads 8 -b 127.0.0.1:8000
+    uvicorn orders.asgi:application --workers 4 --port 8001
+
+Запуск:
+    python benchmarks/read_views.py --token <token> --clients 200 --requests 5000 \
+        --base-url http://127.0.0.1:8000/api/v1/ --async-base-url http://127.0.0.1:8001/api/v1/
+
+Для каждого представления (products, basket, orders) выводит число запросов в секунду,
+медиану и 99-й перцентиль времени ответа синхронной версии (через --base-url)
+и версии async/ (через --async-base-url, по умолчанию тот же сервер).
+Обе версии выполняют одинаковые запросы: поиск товаров сравнивается с products/search,
+а не со списком products, у которого нет фильтра активных магазинов и предварительной загрузки.
+
+'''
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import Session
+
+# Синхронное и асинхронное представление каждой пары выполняют одинаковые запросы к базе данных
+ENDPOINTS = {
+    'products': ('products/search', 'async/products'),
+    'basket': ('basket', 'async/basket'),
+    'orders': ('orders', 'async/orders'),
+}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run(url, headers, clients, requests_count):
+    '''Выполнить requests_count запросов к url из clients потоков'''
+    local = threading.local()
+
+    def request(_):
+        if not hasattr(local, 'session'):
+            local.session = Session()
+            local.session.headers.update(headers)
+        start = time.perf_counter()
+        response = local.session.get(url)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(request, range(requests_count)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    return {
+        'rps': requests_count / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'errors': sum(1 for _, status in results if status != 200),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000/api/v1/', help='Сервер синхронных версий')
+    parser.add_argument('--async-base-url', help='Сервер асинхронных версий, по умолчанию --base-url')
+    parser.add_argument('--token', help='Токен покупателя для basket и orders')
+    parser.add_argument('--clients', type=int, default=100, help='Число одновременных клиентов')
+    parser.add_argument('--requests', type=int, default=2000, help='Число запросов к каждому представлению')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    args = parser.parse_args()
+
+    headers = {'Authorization': f'Token {args.token}'} if args.token else {}
+    print(f'{"endpoint":<16}{"rps":>10}{"p50, ms":>10}{"p99, ms":>10}{"errors":>8}')
+    for endpoint in args.endpoints:
+        sync_path, async_path = ENDPOINTS[endpoint]
+        for base_url, path in ((args.base_url, sync_path), (args.async_base_url or args.base_url, async_path)):
+            result = run(base_url + path, headers, args.clients, args.requests)
+            print(f'{path:<16}{result["rps"]:>10.1f}{result["p50"]:>10.1f}{result["p99"]:>10.1f}{result["errors"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
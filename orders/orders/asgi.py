@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orders.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from backend.events import order_events_application  # noqa: E402 - needs configured Django
+
+ORDER_EVENTS_PATH = '/api/v1/orders/events'
+
+
+async def application(scope, receive, send):
+    # Django 4.1 streams responses synchronously, so the event stream is served by a separate ASGI app
+    if scope['type'] == 'http' and scope['path'] == ORDER_EVENTS_PATH:
+        return await order_events_application(scope, receive, send)
+    return await django_application(scope, receive, send)
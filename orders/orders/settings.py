@@ -14,6 +14,7 @@ from pathlib import Path
 
 import os
 from dotenv import load_dotenv
+from kombu import Queue
 
 load_dotenv()
 
@@ -100,10 +101,41 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        # Persistent connections: a connection is reused by the requests of one thread for DB_CONN_MAX_AGE seconds
+        # (0 - a new connection for every request) and checked before reuse after an error or a restart of the server.
+        # Only for WSGI and Celery workers: under ASGI every request runs in a new thread and its persistent connection
+        # is never reused, so keep 0 there and pool connections with pgbouncer
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 0)),
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'true').lower() in ('true', '1', 'yes'),
     }
 }
+# DB_POOLER=pgbouncer: connections go through a pooler in transaction mode (DB_HOST/DB_PORT point to the pooler),
+# server-side cursors don't survive between transactions there
+DB_POOLER = os.getenv('DB_POOLER', '')
+if DB_POOLER == 'pgbouncer':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
 
 
+AUTHENTICATION_BACKENDS = [
+    'backend.authentication.PooledModelBackend',
+]
+
+# PBKDF2 cost; password hashing runs in a bounded per-process thread pool
+PASSWORD_HASHERS = [
+    'backend.hashers.ConfigurablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+PASSWORD_HASHER_ITERATIONS = int(os.getenv('PASSWORD_HASHER_ITERATIONS', 390000))
+PASSWORD_HASHING_WORKERS = int(os.getenv('PASSWORD_HASHING_WORKERS', 2))
+PASSWORD_HASHING_TIMEOUT = int(os.getenv('PASSWORD_HASHING_TIMEOUT', 10))
+# Bulk onboarding hashes passwords in a Celery task on the import queue, in its own thread pool of this size
+ONBOARDING_HASHING_WORKERS = int(os.getenv('ONBOARDING_HASHING_WORKERS', 4))
+# The CSV rows with passwords wait for the task in Redis, not in the task message, at most this many seconds
+ONBOARDING_ROWS_TTL = int(os.getenv('ONBOARDING_ROWS_TTL', 60 * 60))
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -156,6 +188,16 @@ EMAIL_PORT = int(os.getenv('EMAIL_PORT'))
 EMAIL_USE_TLS = bool(os.getenv('EMAIL_USE_TLS'))
 SERVER_EMAIL = EMAIL_HOST_USER
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+# Email tasks reuse one SMTP connection per worker thread, see backend.mail
+
+# Order notifications outbox: drain interval, batch size, retries with exponential backoff, sent rows retention
+EMAIL_OUTBOX_INTERVAL = int(os.getenv('EMAIL_OUTBOX_INTERVAL', 5))
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', 100))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
+EMAIL_OUTBOX_RETRY_DELAY = int(os.getenv('EMAIL_OUTBOX_RETRY_DELAY', 60))
+EMAIL_OUTBOX_RETENTION = int(os.getenv('EMAIL_OUTBOX_RETENTION', 60 * 60 * 24 * 7))
+# Shop users get one email with all their new orders placed within this window, seconds
+PARTNER_NOTIFICATION_WINDOW = int(os.getenv('PARTNER_NOTIFICATION_WINDOW', 60))
 
 
 REST_FRAMEWORK = {
@@ -168,7 +210,7 @@ REST_FRAMEWORK = {
     ),
 
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'backend.authentication.CachedTokenAuthentication',
     ),
 
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
@@ -184,17 +226,110 @@ REST_FRAMEWORK = {
 }
 
 if not bool(os.getenv('TEST')):
+    # Counters are kept in Redis: the limits hold for all web server processes together
     REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle',
-    ],
+        'backend.throttling.AnonRateThrottle',
+        'backend.throttling.UserRateThrottle',
+    ]
     REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] = {
         'anon': '20/minute',
         'user': '120/minute'
     }
 
-CELERY_BROKER_URL = "redis://localhost:6378"
-CELERY_RESULT_BACKEND = "redis://localhost:6378"
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6378')
+
+# Cache shared by all web server processes and Celery workers
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'cache',
+    }
+}
+
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
+# Task results are never read, tasks don't store them
+CELERY_TASK_IGNORE_RESULT = True
+# Separate queues, each served by its own workers: emails never wait behind price imports
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_QUEUES = (
+    Queue('default'),
+    Queue('email'),
+    Queue('import'),
+    Queue('maintenance'),
+)
+CELERY_TASK_ROUTES = {
+    'backend.tasks.new_user_registered_task': {'queue': 'email'},
+    'backend.tasks.new_users_registered_task': {'queue': 'email'},
+    'backend.tasks.send_outbox_emails_task': {'queue': 'email'},
+    'backend.tasks.partner_update_task': {'queue': 'import'},
+    'backend.tasks.onboard_users_task': {'queue': 'import'},
+    'backend.tasks.delete_expired_tokens_task': {'queue': 'maintenance'},
+    'backend.tasks.delete_expired_confirm_email_tokens_task': {'queue': 'maintenance'},
+}
+# A worker reserves one task per process instead of hoarding the queue
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv('CELERY_WORKER_PREFETCH_MULTIPLIER', 1))
+# Soft time limits, seconds: the hard limit kills the task 30 seconds later
+IMPORT_TASK_TIME_LIMIT = int(os.getenv('IMPORT_TASK_TIME_LIMIT', 600))
+# Price list import: download timeout and how long the import status is kept, seconds
+PARTNER_IMPORT_REQUEST_TIMEOUT = int(os.getenv('PARTNER_IMPORT_REQUEST_TIMEOUT', 30))
+PARTNER_IMPORT_STATUS_TTL = int(os.getenv('PARTNER_IMPORT_STATUS_TTL', 60 * 60 * 24 * 7))
+EMAIL_TASK_TIME_LIMIT = int(os.getenv('EMAIL_TASK_TIME_LIMIT', 300))
+CELERY_TASK_ANNOTATIONS = {
+    task: {'soft_time_limit': limit, 'time_limit': limit + 30}
+    for task, limit in (
+        ('backend.tasks.partner_update_task', IMPORT_TASK_TIME_LIMIT),
+        ('backend.tasks.onboard_users_task', IMPORT_TASK_TIME_LIMIT),
+        ('backend.tasks.new_user_registered_task', EMAIL_TASK_TIME_LIMIT),
+        ('backend.tasks.new_users_registered_task', EMAIL_TASK_TIME_LIMIT),
+        ('backend.tasks.send_outbox_emails_task', EMAIL_TASK_TIME_LIMIT),
+    )
+}
+CELERY_BEAT_SCHEDULE = {
+    'send-outbox-emails': {
+        'task': 'backend.tasks.send_outbox_emails_task',
+        'schedule': EMAIL_OUTBOX_INTERVAL,
+    },
+    'delete-expired-tokens': {
+        'task': 'backend.tasks.delete_expired_tokens_task',
+        'schedule': 60 * 60,
+    },
+    'delete-expired-confirm-email-tokens': {
+        'task': 'backend.tasks.delete_expired_confirm_email_tokens_task',
+        'schedule': 60 * 60,
+    },
+}
+
+# Static credential of the metrics endpoint for Prometheus ("Authorization: Bearer <token>"), it never expires
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Order events stream (ASGI only): heartbeat interval, seconds, and per-client queue size
+ORDER_EVENTS_HEARTBEAT = int(os.getenv('ORDER_EVENTS_HEARTBEAT', 15))
+ORDER_EVENTS_QUEUE_SIZE = int(os.getenv('ORDER_EVENTS_QUEUE_SIZE', 100))
+
+# Basket storage: 'db' - Order/OrderItem in database, 'redis' - hash in Redis until checkout
+BASKET_STORAGE = os.getenv('BASKET_STORAGE', 'db')
+BASKET_TTL = int(os.getenv('BASKET_TTL', 60 * 60 * 24 * 30))
+
+# Lifetime of saved responses for requests with Idempotency-Key header, seconds
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 60 * 60 * 24))
+# Lifetime of the in-progress marker, seconds: longer than the worker request timeout, so a request killed
+# with its worker doesn't block retries with the same key for IDEMPOTENCY_KEY_TTL
+IDEMPOTENCY_LOCK_TTL = int(os.getenv('IDEMPOTENCY_LOCK_TTL', 60))
+
+# Auth token lifetime and batch size of the periodic expired tokens cleanup
+AUTH_TOKEN_TTL = int(os.getenv('AUTH_TOKEN_TTL', 60 * 60 * 24 * 7))
+AUTH_TOKEN_CLEANUP_BATCH_SIZE = int(os.getenv('AUTH_TOKEN_CLEANUP_BATCH_SIZE', 1000))
+
+# Email confirmation token lifetime and batch size of the periodic expired tokens/inactive users cleanup
+CONFIRM_EMAIL_TOKEN_TTL = int(os.getenv('CONFIRM_EMAIL_TOKEN_TTL', 60 * 60 * 24 * 3))
+CONFIRM_EMAIL_TOKEN_CLEANUP_BATCH_SIZE = int(os.getenv('CONFIRM_EMAIL_TOKEN_CLEANUP_BATCH_SIZE', 500))
+
+# Token -> user cache: Redis entry lifetime, per-process LRU entry lifetime and size
+AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', 60))
+AUTH_TOKEN_LOCAL_CACHE_TTL = int(os.getenv('AUTH_TOKEN_LOCAL_CACHE_TTL', 5))
+AUTH_TOKEN_LOCAL_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_LOCAL_CACHE_SIZE', 10000))
 
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Orders API',
@@ -204,7 +339,7 @@ SPECTACULAR_SETTINGS = {
     'SWAGGER_UI_DIST': 'SIDECAR',  
     'SWAGGER_UI_FAVICON_HREF': 'SIDECAR',
     'REDOC_DIST': 'SIDECAR',
-    'AUTHENTICATION_WHITELIST': ['rest_framework.authentication.TokenAuthentication',],
+    'AUTHENTICATION_WHITELIST': ['backend.authentication.CachedTokenAuthentication',],
 }
 
 AUTHENTICATION_BACKEND = [